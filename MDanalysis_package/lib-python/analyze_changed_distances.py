@@ -246,7 +246,9 @@ class TrajectoryChanges(object):
 
         Given atom pair must correspond to a pair used in the
         'detect_changed_distances' analysis. Change points for this time series
-        at sensitivity level lam are plotted if lam is provided.
+        at sensitivity level lam are plotted if lam is provided. For analyses
+        run with --binary-contacts, the contact indicator is plotted instead of
+        the distance.
 
         Arguments:
             changed_pair -- ('(chain)residue:atom', '(chain)residue:atom')
@@ -268,7 +270,10 @@ class TrajectoryChanges(object):
         fig = plt.figure()
         ax = fig.add_subplot(111)
         dists = self._h5.root.data[idx]
-        if self._info['contact_dist'] > 0:
+        binary = self._info.get('binary_contacts', False)
+        if binary:
+            dists = np.unpackbits(dists)[:len(self._info['frame_inds'])]
+        elif self._info['contact_dist'] > 0:
             np.random.seed(idx)
             dists -= np.random.uniform(0.0,0.1,size=len(dists))
             dists = self._info['contact_dist'] / (1.0 / dists - 1) ** 0.2
@@ -279,7 +284,10 @@ class TrajectoryChanges(object):
                             ((a1,a0)) in self._changes[lam][t]]
             ax.plot(times, np.median(dists) * np.ones(len(times)), 'ro')
         ax.xaxis.set_label_text('Frame')
-        ax.yaxis.set_label_text('Distance (A) between atoms %s and %s' % (changed_pair[0], changed_pair[1]))
+        if binary:
+            ax.yaxis.set_label_text('Contact between atoms %s and %s' % (changed_pair[0], changed_pair[1]))
+        else:
+            ax.yaxis.set_label_text('Distance (A) between atoms %s and %s' % (changed_pair[0], changed_pair[1]))
         fig.show()
 
     def matrixPlotChange(self, change, lam=None):
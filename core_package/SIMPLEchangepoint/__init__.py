@@ -33,14 +33,369 @@ import numpy as np
 import scipy.sparse
 from collections import defaultdict
 import _univariate_changes
+import hashlib
 import sys
+import zlib
+
+COSTS = ('laplace', 'normal_mean', 'normal_var', 'bernoulli')
+
+def _standardize(data, cost):
+    """Rescales (J x T) float32 data in place to the fixed parameters of the
+    Normal cost models: unit noise variance for 'normal_mean', estimated
+    robustly from successive differences, and zero median for 'normal_var'.
+    Returns the (J,) arrays (shift, scale) such that the original data are
+    scale * data + shift.
+    """
+    shift = np.zeros(data.shape[0])
+    scale = np.ones(data.shape[0])
+    if cost == 'normal_mean' and data.shape[1] > 1:
+        diffs = np.diff(data, axis=1)
+        scale = np.median(np.abs(diffs), axis=1) / (0.6745 * np.sqrt(2))
+        fallback = np.std(diffs, axis=1) / np.sqrt(2)
+        scale[scale == 0] = fallback[scale == 0]
+        scale[scale == 0] = 1
+        data /= scale[:, np.newaxis]
+    elif cost == 'normal_var':
+        shift = np.median(data, axis=1)
+        data -= shift[:, np.newaxis]
+    return shift, scale
+
+class GroupIndex(object):
+    """Group memberships of J time series, indexed once for ComputeChanges.
+
+    Can be passed as the groups argument of ComputeChanges in place of the
+    list of groups, and reused by any number of calls on data with J time
+    series.
+
+    Attributes:
+        J -- Number of time series.
+
+        sizes -- (groups,) array of the number of time series in each group.
+
+        indptr, members -- Time series of group g, in increasing order, are
+            members[indptr[g]:indptr[g+1]].
+
+        row_indptr, row_groups -- Groups of time series j, in increasing
+            order, are row_groups[row_indptr[j]:row_indptr[j+1]].
+
+        signatures, signature -- Distinct lists of groups of the time series,
+            and the (J,) array of the index in signatures of each time series.
+
+        dtype -- Smallest unsigned integer type that holds any group size.
+    """
+    def __init__(self, groups, J):
+        groups = [sorted(set(group)) for group in groups]
+        self.J = J
+        self.sizes = np.array([len(group) for group in groups], dtype='int')
+        self.indptr = np.concatenate([[0], np.cumsum(self.sizes)])
+        self.members = np.array([ind for group in groups for ind in group],
+                dtype='int32')
+        if len(self.members) > 0 and (self.members.min() < 0
+                or self.members.max() >= J):
+            raise ValueError('Group members must be in the range 0, ..., J-1')
+        # A stable sort by time series keeps the groups of each in order
+        order = np.argsort(self.members, kind='mergesort')
+        self.row_groups = np.repeat(np.arange(len(groups), dtype='int32'),
+                self.sizes)[order]
+        self.row_indptr = np.concatenate([[0],
+                np.cumsum(np.bincount(self.members, minlength=J))])
+        ids = {}
+        self.signatures = []
+        self.signature = np.zeros(J, dtype='int')
+        for ind in range(J):
+            key = tuple(self.groups_of(ind))
+            if key not in ids:
+                ids[key] = len(self.signatures)
+                self.signatures.append(list(key))
+            self.signature[ind] = ids[key]
+        max_size = self.sizes.max() if len(groups) > 0 else 0
+        if max_size <= 255:
+            self.dtype = np.uint8
+        elif max_size <= 65535:
+            self.dtype = np.uint16
+        else:
+            self.dtype = np.uint32
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def groups_of(self, ind):
+        """Groups of time series ind, as a list in increasing order."""
+        start, end = self.row_indptr[ind], self.row_indptr[ind+1]
+        return self.row_groups[start:end].tolist()
+
+    def matrix(self):
+        """Sparse (groups x J) CSR incidence matrix of type dtype."""
+        return scipy.sparse.csr_matrix((np.ones(len(self.members),
+            dtype=self.dtype), self.members, self.indptr),
+            shape=(len(self), self.J))
+
+    def counts(self, changed):
+        """Array of |changed intersect G| for each group G, for a ChangeSet or
+        other collection of time series changed.
+        """
+        if isinstance(changed, ChangeSet):
+            inds = changed.indices()
+        else:
+            inds = np.array(sorted(changed), dtype='int')
+        starts = self.row_indptr[inds]
+        lengths = self.row_indptr[inds+1] - starts
+        # Positions in row_groups of the groups of every changed time series
+        pos = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) \
+                + np.arange(lengths.sum())
+        return np.bincount(self.row_groups[pos], minlength=len(self))
+
+    def penalty(self, changed, lam, alpha, beta):
+        """lam*(sum_{G in groups} |changed intersect G|^beta)^alpha for a set
+        of time series changed, adding the terms in order of group.
+        """
+        counts = self.counts(changed)
+        return lam * (sum([c ** beta for c in
+            counts[counts > 0].tolist()])) ** alpha
+
+class ChangeSet(object):
+    """Immutable set of the time series, out of J, that change at one time.
+
+    Stored as a sorted int32 array of indices while that is smaller than a
+    bitmap of J bits, and as the bitmap (packed with np.packbits) otherwise,
+    so equal sets always have equal storage. Union, intersection and
+    equality run on whole arrays, and ComputeChanges keeps every iteration's
+    changes in this form.
+    """
+    __slots__ = ('J', '_size', '_dense', '_data')
+
+    def __init__(self, inds, J, presorted=False):
+        inds = np.asarray(inds, dtype='int32')
+        if not presorted:
+            inds = np.unique(inds)
+        self._set(inds, None, J)
+
+    def _set(self, inds, bits, J):
+        # Exactly one of inds (sorted indices) and bits (J booleans) is given
+        self.J = J
+        if inds is None:
+            self._size = int(np.count_nonzero(bits))
+        else:
+            self._size = len(inds)
+        self._dense = 32 * self._size > J
+        if self._dense:
+            if bits is None:
+                bits = np.zeros(J, dtype='bool')
+                bits[inds] = True
+            self._data = np.packbits(bits)
+        elif inds is None:
+            self._data = np.flatnonzero(bits).astype('int32')
+        else:
+            self._data = inds
+
+    @classmethod
+    def _from_bits(cls, bits, J):
+        result = cls.__new__(cls)
+        result._set(None, bits, J)
+        return result
+
+    def _bits(self):
+        if self._dense:
+            return np.unpackbits(self._data)[:self.J].view('bool')
+        bits = np.zeros(self.J, dtype='bool')
+        bits[self._data] = True
+        return bits
+
+    def indices(self):
+        """Sorted int32 array of the time series in the set."""
+        if self._dense:
+            return np.flatnonzero(self._bits()).astype('int32')
+        return self._data
+
+    def contains(self, inds):
+        """Boolean array of whether each of the time series inds is in the
+        set.
+        """
+        inds = np.asarray(inds, dtype='int')
+        if self._dense:
+            return self._bits()[inds]
+        if self._size == 0:
+            return np.zeros(len(inds), dtype='bool')
+        pos = np.minimum(np.searchsorted(self._data, inds), self._size - 1)
+        return self._data[pos] == inds
+
+    def to_set(self):
+        return set(self.indices().tolist())
+
+    def tostring(self):
+        """Byte string that equal ChangeSets, and only they, share."""
+        return np.array([self.J, self._size, self._dense],
+                dtype='int64').tostring() + self._data.tostring()
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        return iter(self.indices().tolist())
+
+    def __contains__(self, ind):
+        return bool(self.contains([ind])[0])
+
+    def __or__(self, other):
+        assert self.J == other.J, 'ChangeSets must be over the same J.'
+        if self._dense or other._dense:
+            return ChangeSet._from_bits(self._bits() | other._bits(), self.J)
+        return ChangeSet(np.union1d(self._data, other._data), self.J, True)
+
+    def __and__(self, other):
+        assert self.J == other.J, 'ChangeSets must be over the same J.'
+        if self._dense and other._dense:
+            return ChangeSet._from_bits(self._bits() & other._bits(), self.J)
+        return ChangeSet(np.intersect1d(self.indices(), other.indices()),
+                self.J, True)
+
+    def __eq__(self, other):
+        if not isinstance(other, ChangeSet):
+            return NotImplemented
+        return self.J == other.J and self._size == other._size and \
+                self._dense == other._dense and \
+                np.array_equal(self._data, other._data)
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    __hash__ = None
+
+    def __getstate__(self):
+        return (self.J, self._size, self._dense, self._data)
+
+    def __setstate__(self, state):
+        self.J, self._size, self._dense, self._data = state
+
+    def __repr__(self):
+        return 'ChangeSet(%r, %d)' % (self.indices().tolist(), self.J)
+
+def _encode_changes(changes):
+    """Byte string of a dict of ChangeSets, equal for equal dicts."""
+    return ''.join([np.array([t], dtype='int64').tostring()
+        + changes[t].tostring() for t in sorted(changes)])
+
+def _change_diff(old, new):
+    """Counts of the change times of new that were 'times_added' to old,
+    'times_removed' from it and 'times_moved' (the same time series changing
+    at a time not in old instead of one not in new), and of times in both at
+    which the changed time series were 'times_modified'.
+    """
+    added = [t for t in new if t not in old]
+    removed = [t for t in old if t not in new]
+    modified = len([t for t in new if t in old and new[t] != old[t]])
+    # Pair the removed and added times with the same changed time series
+    unmatched = defaultdict(int)
+    for t in removed:
+        unmatched[old[t].tostring()] += 1
+    moved = 0
+    for t in added:
+        key = new[t].tostring()
+        if unmatched[key] > 0:
+            unmatched[key] -= 1
+            moved += 1
+    return {'times_added': len(added) - moved,
+            'times_removed': len(removed) - moved,
+            'times_moved': moved, 'times_modified': modified}
+
+def _collect_changes(inds, changes_per_ind, J):
+    """Dict mapping each change time of the time series inds, with change
+    times changes_per_ind, to the ChangeSet of those that change then.
+    """
+    if len(inds) == 0:
+        return {}
+    times = np.concatenate(changes_per_ind)
+    rows = np.repeat(np.asarray(inds, dtype='int32'),
+            [len(c) for c in changes_per_ind])
+    order = np.lexsort((rows, times))
+    times, rows = times[order], rows[order]
+    bounds = np.concatenate([[0], np.flatnonzero(np.diff(times)) + 1,
+        [len(times)]])
+    return dict((int(times[start]), ChangeSet(rows[start:end], J, True))
+            for start, end in zip(bounds[:-1], bounds[1:]))
+
+def _power_sums(totals, beta):
+    """Column sums of totals**beta for a sparse (groups x K) matrix of
+    change counts, adding the nonzero counts of each column in order of group
+    as the sum of the dense matrix would.
+    """
+    totals = scipy.sparse.csc_matrix(totals)
+    totals.sort_indices()
+    K = totals.shape[1]
+    nnz = np.diff(totals.indptr)
+    padded = np.zeros((max(nnz.max() if K > 0 else 0, 1), K))
+    cols = np.repeat(np.arange(K), nnz)
+    padded[np.arange(totals.nnz) - totals.indptr[cols], cols] = \
+            totals.data**beta
+    return padded.sum(axis=0)
+
+def _marginal_penalties(totals, current, signatures, lam, alpha, beta,
+                        chunk=1 << 20):
+    """Marginal penalties at each change time of time series in the given
+    lists of groups (signatures), given the (groups x K) sparse change counts
+    totals of each group at the K change times and their power sums current.
+
+    Yields (ids, up, down) for blocks of signature indices ids, where row k
+    of the (len(ids) x K) arrays up and down holds the penalty for adding a
+    change of a time series in groups signatures[ids[k]] at each change time,
+    and for keeping one that it already has. Each block holds signatures of
+    the same length and at most about chunk values.
+    """
+    K = totals.shape[1]
+    by_length = defaultdict(list)
+    for s, sig in enumerate(signatures):
+        by_length[len(sig)].append(s)
+    step = max(chunk // max(K, 1), 1)
+    for length, ids in sorted(by_length.iteritems()):
+        for start in range(0, len(ids), step):
+            block = ids[start:start+step]
+            up = np.zeros((len(block), K))
+            down = np.zeros((len(block), K))
+            # Add the terms of one group of every signature at a time, in
+            # the order in which a sum over each signature would
+            for m in range(length):
+                submat = totals[[signatures[s][m] for s in block], :].toarray()
+                up += (submat+1)**beta - submat**beta
+                down += np.maximum(submat-1,0)**beta - submat**beta
+            cup = current + up
+            cdown = np.maximum(current + down, 0)
+            yield (block, lam * (cup**alpha - current**alpha),
+                   lam * (current**alpha - cdown**alpha))
+
+def _fit_segments(data, ranks, shift, scale, row_times, workspace, cost):
+    """List of the (location, scale, log-likelihood) rows of the segments of
+    each row of data between its change times row_times (each starting at 0
+    and ending at T), undoing the standardization by shift and scale unless
+    these are None.
+    """
+    offsets = np.cumsum([0] + [len(times) for times in row_times])
+    segments = _univariate_changes.segment_stats(data, offsets,
+            np.concatenate(row_times), threads=workspace.threads,
+            workspace=workspace, ranks=ranks, cost=cost)
+    row_segments = []
+    for i in range(len(row_times)):
+        start, end = offsets[i] - i, offsets[i+1] - i - 1
+        row = segments[start:end]
+        if shift is not None:
+            row[:, :2] *= scale[i]
+            row[:, 0] += shift[i]
+        row_segments.append(row)
+    return row_segments
 
 def ComputeChanges(data, lam, alpha=0.7, groups=None, beta=1.0, lam_min=None,
-                   verbose=True, parallel=False, seeds=None, max_iters=100):
+                   verbose=True, parallel=False, seeds=None, max_iters=100,
+                   threads=1, cost='laplace', frames=None,
+                   max_segment_length=None, return_segments=False,
+                   seed_method='dp', iteration_info=None,
+                   local_resolve=False):
     """Computes simultaneous change-points in multiple time series.
 
     Fits a model in which data in each segment between change-points for each
-    time series is iid Laplace distributed, and these segments are independent.
+    time series is iid Laplace (or Normal or Bernoulli, see cost) distributed,
+    and these segments are independent.
     Selects the model by maximizing the log-likelihood of the data, subject to
     a penalty for each change time equal to
 
@@ -69,7 +424,8 @@ def ComputeChanges(data, lam, alpha=0.7, groups=None, beta=1.0, lam_min=None,
             each set specifies indices in the range 0, ..., J-1. Changes will
             have a greater tendency of being detected as simultaneous for time
             series within the same subsets. If None, defaults to
-            [ set(1, ..., J) ].
+            [ set(1, ..., J) ]. May also be a GroupIndex of the groups, which
+            saves indexing them again in each call.
 
         beta -- Parameter in (0,1]. Set beta closer to 0 to increase the
             tendency of detecting changes within the same groups as
@@ -93,17 +449,93 @@ def ComputeChanges(data, lam, alpha=0.7, groups=None, beta=1.0, lam_min=None,
             on multiple nodes using MPI.
 
         seeds -- Random-number-generator seeds for randomization of marginal
-            penalty values, in the format [seed_0, ..., seed_{J-1}]. If None,
-            defaults to [0, ..., J-1].
+            penalty values, in the format [seed_0, ..., seed_{J-1}] of
+            integers in the range 0, ..., 2**64-1. The random values of each
+            time series depend only on its seed, not on the other time series
+            or their division across nodes. If None, defaults to
+            [0, ..., J-1]. They are drawn from a Philox4x32-10 generator
+            keyed by the seed, not from numpy.random as in earlier versions,
+            so results for the same seeds may differ slightly from those
+            versions.
 
         max_iters -- Maximum number of iterations for which to run algorithm.
 
+        threads -- Number of native threads used to compute changepoints for
+            the time series on each node. Set to 0 to use all available
+            cores.
+
+        cost -- Segment likelihood, one of 'laplace' (iid Laplace with free
+            location and scale), 'normal_mean' (Normal with free mean and a
+            variance common to each time series) or 'normal_var' (Normal with
+            free variance about a mean common to each time series). The Normal
+            costs are computed from cumulative sums and are much faster, but
+            assume well-behaved data. 'bernoulli' (binary observables with
+            free success probability; values above 0.5 count as 1) is the
+            fastest and also accepts bit-packed data, see frames.
+
+        frames -- If given, data hold binary time series of this length
+            bit-packed along each row as by np.packbits(x, axis=1), in an
+            array of type 'uint8' (e.g. an HDF5 UInt8 CArray). Requires
+            cost='bernoulli'.
+
+        max_segment_length -- If given, changepoints are computed for each
+            time series considering only segments of at most this many
+            frames, which bounds the time and memory per time series by
+            O(T*max_segment_length) even when pruning is ineffective. The
+            changes this forces in longer stationary stretches are then
+            dropped by re-solving over the changes found, so they are never
+            returned or shifted and merged, and returned segments may be
+            longer than max_segment_length. The changes may still differ
+            from those without it.
+
+        seed_method -- How changes are computed in the first iteration:
+            'dp' (exact dynamic programming, as in later iterations) or
+            'binseg' (binary segmentation, O(T log T) segment costs per
+            time series, much faster when the reduced first-iteration
+            penalties leave pruning ineffective). Later iterations always
+            use the exact dynamic program, as do time series in which binary
+            segmentation finds no change, before they are dropped as
+            unchanging. Since the iterations start from different changes,
+            the final changes may differ from those with 'dp'.
+
+        return_segments -- If True, also returns the fitted location and
+            scale and the log-likelihood of every segment of every time
+            series between the returned changes, see below.
+
+        local_resolve -- If True, keeps the arrays of the dynamic program of
+            each time series between iterations (about 24 bytes per frame
+            per time series), and re-solves each time series only from the
+            frames where its penalties changed until the solution again
+            agrees with the previous one, instead of over all T frames. The
+            changes are identical either way.
+
+        iteration_info -- If given, a list to which a dict is appended after
+            each iteration, with the number of time series whose changes
+            were 'solved' again and the number 'skipped' because their
+            penalties were unchanged since they were last solved (summed
+            over nodes), and the numbers of 'change_times' and 'changes'.
+            The dict also holds a 'fingerprint' (hex SHA-1) of the changes,
+            the earlier iteration whose changes they repeat as 'repeat_of'
+            (or None), and the numbers of change times 'times_added',
+            'times_removed', 'times_moved' and 'times_modified' relative to
+            the previous iteration.
+
     Returns:
         { int: set(int, ..., int), ..., int: set(int, ..., int) } where a key of
             t indicates a change time between data points t-1 and t, and the
             set value for that key indicates the observables (a subset of
             {0,...,J-1}) that change at that time.
 
+        If return_segments is True, returns (changes, (offsets, segments)),
+            where rows offsets[j]:offsets[j+1] of the float64 array segments
+            hold (location, scale, log-likelihood) of the segments of time
+            series j in order: the median and mean absolute deviation for
+            'laplace', the mean and standard deviation for the Normal costs
+            and the fraction of ones and its standard deviation for
+            'bernoulli'. The log-likelihoods of the Normal costs are those of
+            the standardized data. With parallel=True, only node 0 receives
+            the segments, and other nodes receive None.
+
     """
     if parallel:
         from mpi4py import MPI
@@ -115,8 +547,15 @@ def ComputeChanges(data, lam, alpha=0.7, groups=None, beta=1.0, lam_min=None,
         world_rank = 0
     if world_rank == 0:
         assert len(data.shape) == 2, 'Data must be 2-dimensional.'
+    assert cost in COSTS, 'cost must be one of ' + ', '.join(COSTS)
+    assert seed_method in ('dp', 'binseg'), "seed_method must be 'dp' or 'binseg'"
     J = int(data.shape[0])
-    T = int(data.shape[1])
+    if frames is None:
+        T = int(data.shape[1])
+    else:
+        assert cost == 'bernoulli', "Bit-packed data require cost='bernoulli'"
+        T = int(frames)
+        assert data.shape[1] == (T+7) / 8, 'Packed data must have (frames+7)/8 columns.'
     if lam_min == None:
         lam_min = 8
         if world_rank == 0:
@@ -132,42 +571,35 @@ def ComputeChanges(data, lam, alpha=0.7, groups=None, beta=1.0, lam_min=None,
         print 'Reading data'
     inds = range(world_rank, J, world_size)
     if groups is None:
-        groups = [set(range(J))]
+        groups = [range(J)]
+    if not isinstance(groups, GroupIndex):
+        groups = GroupIndex(groups, J)
+    assert groups.J == J, 'GroupIndex must be built for J time series.'
+    group_sizes = groups.sizes
+    group_dtype = groups.dtype
+    groups_mat = groups.matrix()
     if len(inds) > 0:
-        data = np.array(data[inds,:], dtype='float32', order='C')
-        group_inds = [[i for i, group in enumerate(groups) if ind in group]
-                for ind in inds]
-
-    if world_rank == 0:
-        group_sizes = np.zeros(len(groups), dtype='int')
-        for g_ind, group in enumerate(groups):
-            group_sizes[g_ind] = len(group)
-        if np.max(group_sizes) <= 255:
-            group_dtype = np.uint8
-        elif np.max(group_sizes) <= 65535:
-            group_dtype = np.uint16
+        if frames is None:
+            data = np.array(data[inds,:], dtype='float32', order='C')
+            shift, scale = _standardize(data, cost)
         else:
-            group_dtype = np.uint32
-        groups_mat = scipy.sparse.lil_matrix((len(groups), J), dtype=group_dtype)
-        for g_ind, group in enumerate(groups):
-            groups_mat[g_ind, list(group)] = 1
-        groups_mat = groups_mat.tocsr()
-    else:
-        groups_mat = None
-        group_sizes = None
-        group_dtype = None
-    if parallel:
-        groups_mat = world.bcast(groups_mat, 0)
-        group_sizes = world.bcast(group_sizes, 0)
-        group_dtype = world.bcast(group_dtype, 0)
+            data = np.array(data[inds,:], dtype='uint8', order='C')
+            shift = scale = None
+        group_inds = [groups.groups_of(ind) for ind in inds]
+        # Groups of each local time series in CSR form for the kernel
+        group_indptr = np.cumsum([0] + [len(g) for g in group_inds])
+        group_indices = np.array([g for gs in group_inds for g in gs],
+                dtype='int32')
 
     # Define penalty function
     def penalty_func(changes):
-        return lam * (sum([(len(changes & group)) ** beta
-            for group in groups])) ** alpha
+        return groups.penalty(changes, lam, alpha, beta)
 
     if world_rank == 0:
-        change_history = []
+        # Fingerprints of the changes of every iteration so far, each with
+        # the iterations and compressed changes that had it
+        history = defaultdict(list)
+        prev_changes = {}
         if verbose:
             print 'Starting iteration 0'
             sys.stdout.write('...initializing penalties ')
@@ -176,23 +608,24 @@ def ComputeChanges(data, lam, alpha=0.7, groups=None, beta=1.0, lam_min=None,
     if len(inds) > 0:
         # For first iteration, use random penalties between
         # 0.9 * minimum marginal penalty and 1.0 * minimum marginal penalty
-        rands = np.zeros((len(inds), T-1), dtype='float32', order='C')
+        # The random factors of each time series are regenerated from its
+        # seed whenever needed, independently of the other time series
+        if seeds is None:
+            keys = np.array(inds, dtype='uint64')
+        else:
+            keys = np.array([seeds[ind] for ind in inds], dtype='uint64')
         penalties = np.zeros((len(inds), T-1), dtype='float32', order='C')
         current = sum(group_sizes**beta)
+        marginals = np.zeros(len(inds))
         for i, ind in enumerate(inds):
-            if seeds is None:
-                np.random.seed(ind)
-            else:
-                np.random.seed(seeds[ind])
-            rands[i] = np.random.uniform(0.9, 1, T-1)
             new = current - sum(group_sizes[group_inds[i]]**beta) \
                     + sum((group_sizes[group_inds[i]]-1)**beta)
             if new < 0:
                 new = 0
-            penalties[i] = lam * (current**alpha - new**alpha) * rands[i]
-        mask = penalties < (0.9 * lam_min)
-        penalties[mask] = rands[mask] * lam_min
-        Nraise, Ntot = mask.sum(), mask.size
+            marginals[i] = lam * (current**alpha - new**alpha)
+        Nraise = _univariate_changes.jitter(penalties, keys, marginals,
+                0.9, 1.0, lam_min)
+        Ntot = penalties.size
         if parallel:
             lst = world.gather((Nraise, Ntot), 0)
             if world_rank == 0:
@@ -201,41 +634,119 @@ def ComputeChanges(data, lam, alpha=0.7, groups=None, beta=1.0, lam_min=None,
             fmt = "(raised %d/%d penalties using lam_min=%g)\n"
             sys.stdout.write(fmt % (Nraise, Ntot, lam_min))
 
+    # The data never change, so rank each time series once and reuse the
+    # ranks in every call to the kernel
+    workspace = _univariate_changes.Workspace(T, threads)
+    ranks = None
+    if len(inds) > 0 and cost == 'laplace':
+        ranks = _univariate_changes.compute_ranks(data,
+                threads=workspace.threads, workspace=workspace)
     prev_nchange_times = T
     shift_and_merge = False
-    disabled = [False for i in range(len(inds))]
+    # Position of each local time series in the working arrays, or -1 once it
+    # is dropped from them, and the segments of the dropped time series
+    local_pos = np.arange(len(inds))
+    dropped_inds, dropped_segments = [], []
+    # Changes of each time series from the dynamic program (before shifting),
+    # and a hash of the penalties they were computed with. A time series
+    # whose penalties have not changed since has the same changes.
+    row_cache = [None for i in range(len(inds))]
+    row_prints = [None for i in range(len(inds))]
     for iter in range(max_iters):
         # Compute new changes using previous penalties
         if verbose and world_rank == 0:
             print '...computing changepoints marginally'
-        new_changes = defaultdict(set)
-        changes_per_ind = []
-        for i, ind in enumerate(inds):
-            if not disabled[i]:
-                try:
-                    changes_per_ind.append(_univariate_changes.find_changes(
-                        data[i], penalties[i]))
-                except MemoryError:
-                    print 'Memory error in observable ' + str(ind)
-                    raise
-            else:
-                changes_per_ind.append([])
-            if iter == 0 and len(changes_per_ind[-1]) == 0:
-                disabled[i] = True
-            changes_per_ind[-1] = [0] + changes_per_ind[-1] + [T]
-            for t in changes_per_ind[-1]:
-                new_changes[t].add(ind)
+        changes_per_ind = [np.array([0, T], dtype='int32')
+                for i in range(len(inds))]
+        nsolved = nskipped = 0
+        if len(inds) > 0:
+            binseg = iter == 0 and seed_method == 'binseg'
+            prints = _univariate_changes.fingerprints(penalties)
+            active = []
+            for i in range(len(inds)):
+                if row_cache[i] is not None and row_prints[i] == prints[i]:
+                    # Copy, since shifting below modifies changes in place
+                    changes_per_ind[i] = row_cache[i].copy()
+                    nskipped += 1
+                else:
+                    active.append(i)
+            nsolved = len(active)
+            try:
+                offsets, times = _univariate_changes.find_changes_batch(data,
+                        penalties, threads=workspace.threads, rows=active,
+                        boundaries=True, workspace=workspace, ranks=ranks,
+                        cost=cost, max_segment_length=max_segment_length or 0,
+                        binseg=binseg, resume=local_resolve)
+            except MemoryError, e:
+                print 'Memory error in observables: ' + str(e)
+                raise
+            for k, i in enumerate(active):
+                changes_per_ind[i] = times[offsets[k]:offsets[k+1]]
+                # Binary segmentation is not exact, so never reuse its changes
+                if not binseg:
+                    row_cache[i] = changes_per_ind[i].copy()
+                    row_prints[i] = prints[i]
+            if binseg:
+                # Time series without changes are dropped below, so solve
+                # those that binary segmentation left empty exactly
+                empty = [i for i in active if len(changes_per_ind[i]) == 2]
+                offsets, times = _univariate_changes.find_changes_batch(data,
+                        penalties, threads=workspace.threads, rows=empty,
+                        boundaries=True, workspace=workspace, ranks=ranks,
+                        cost=cost, max_segment_length=max_segment_length or 0)
+                for k, i in enumerate(empty):
+                    changes_per_ind[i] = times[offsets[k]:offsets[k+1]]
+        if parallel:
+            lst = world.gather((nsolved, nskipped), 0)
+            if world_rank == 0:
+                nsolved, nskipped = np.sum(lst, axis=0)
+        drop = []
+        if iter == 0:
+            drop = [i for i in range(len(inds)) if len(changes_per_ind[i]) == 2]
+        if len(drop) > 0:
+            # Time series without changes in the first iteration are never
+            # solved again, so compact the working arrays to the others
+            keep = [i for i in range(len(inds)) if len(changes_per_ind[i]) > 2]
+            if return_segments:
+                dropped_inds = [inds[i] for i in drop]
+                dropped_segments = _fit_segments(data[drop],
+                        None if ranks is None else ranks[drop],
+                        None if shift is None else shift[drop],
+                        None if scale is None else scale[drop],
+                        [[0, T] for i in drop], workspace, cost)
+            local_pos[:] = -1
+            local_pos[keep] = np.arange(len(keep))
+            data = data[keep]
+            if ranks is not None:
+                ranks = ranks[keep]
+            if shift is not None:
+                shift, scale = shift[keep], scale[keep]
+            penalties, keys = penalties[keep], keys[keep]
+            inds = [inds[i] for i in keep]
+            group_inds = [group_inds[i] for i in keep]
+            group_indptr = np.cumsum([0] + [len(g) for g in group_inds])
+            group_indices = np.array([g for gs in group_inds for g in gs],
+                    dtype='int32')
+            changes_per_ind = [changes_per_ind[i] for i in keep]
+            row_cache = [row_cache[i] for i in keep]
+            row_prints = [row_prints[i] for i in keep]
+            # Saved solutions are kept by row, so start a new workspace
+            workspace = _univariate_changes.Workspace(T, threads)
+        new_changes = _collect_changes(inds, changes_per_ind, J)
         if verbose and world_rank == 0 and parallel:
             print '...gathering changepoints'
         if parallel:
             all_new_changes = world.gather(new_changes, 0)
         else:
             all_new_changes = [new_changes]
-        changes = defaultdict(set)
+        changes = {}
         if world_rank == 0:
             for new_changes in all_new_changes:
                 for t, changed_inds in new_changes.iteritems():
-                    changes[t].update(changed_inds)
+                    if t in changes:
+                        changes[t] = changes[t] | changed_inds
+                    else:
+                        changes[t] = changed_inds
             if verbose and parallel:
                 print '...broadcasting combined changes'
         if parallel:
@@ -244,17 +755,28 @@ def ComputeChanges(data, lam, alpha=0.7, groups=None, beta=1.0, lam_min=None,
         # Shift change times
         if len(changes) < T-1 and len(changes) >= prev_nchange_times:
             shift_and_merge = True
-        if shift_and_merge:
-            if verbose and world_rank == 0:
-                print '...shifting/merging change times'
+        if shift_and_merge and verbose and world_rank == 0:
+            print '...shifting/merging change times'
+        if shift_and_merge and not parallel:
+            # All rows are local, so the whole stage runs in the kernel
+            offsets = np.cumsum([0] + [len(c) for c in changes_per_ind])
+            offsets, times = _univariate_changes.shift_and_merge(data,
+                    offsets, np.concatenate(changes_per_ind), group_indptr,
+                    group_indices, lam, alpha, beta, workspace=workspace,
+                    ranks=ranks, cost=cost)
+            for i, ind in enumerate(inds):
+                changes_per_ind[i] = times[offsets[i]:offsets[i+1]]
+            changes = _collect_changes(inds, changes_per_ind, J)
+        elif shift_and_merge:
             change_times = changes.keys()
             change_times.sort()
             prev_change_ind = [0] * len(inds)
             next_change_ind = [0] * len(inds)
             t = 0
             while t < len(change_times) - 2:
-                ll_diffs = np.zeros((len(inds), change_times[t+2]
-                    - change_times[t]+1), dtype='float64')
+                width = change_times[t+2] - change_times[t] + 1
+                rows, prevs, nexts = [], [], []
+                moving = changes[change_times[t+1]].contains(inds)
                 for i, ind in enumerate(inds):
                     while changes_per_ind[i][prev_change_ind[i]+1] \
                             <= change_times[t]:
@@ -262,16 +784,25 @@ def ComputeChanges(data, lam, alpha=0.7, groups=None, beta=1.0, lam_min=None,
                     while changes_per_ind[i][next_change_ind[i]] \
                             < change_times[t+2]:
                         next_change_ind[i] += 1
-                    if ind not in changes[change_times[t+1]]:
+                    if not moving[i]:
                         continue
-                    ll_diffs[i] = _univariate_changes.ll_difference(data[i],
-                            changes_per_ind[i][prev_change_ind[i]],
-                            changes_per_ind[i][next_change_ind[i]],
-                            change_times[t], change_times[t+2])
+                    rows.append(i)
+                    prevs.append(changes_per_ind[i][prev_change_ind[i]])
+                    nexts.append(changes_per_ind[i][next_change_ind[i]])
+                if len(rows) > 0:
+                    # One kernel call for the windows of all changed rows
+                    ll_diffs = _univariate_changes.ll_differences(data, rows,
+                            prevs, nexts, [change_times[t]] * len(rows),
+                            [change_times[t+2]] * len(rows),
+                            threads=workspace.threads, workspace=workspace,
+                            ranks=ranks, cost=cost)
+                    ll_diffs = ll_diffs.reshape(len(rows), width).sum(axis=0)
+                else:
+                    ll_diffs = np.zeros(width, dtype='float64')
                 if parallel:
-                    all_ll_diffs = world.gather(ll_diffs.sum(axis=0), 0)
+                    all_ll_diffs = world.gather(ll_diffs, 0)
                 else:
-                    all_ll_diffs = [ll_diffs.sum(axis=0)]
+                    all_ll_diffs = [ll_diffs]
                 if world_rank == 0:
                     total_ll_diffs = sum(all_ll_diffs)
                     total_ll_diffs[0] -= \
@@ -291,42 +822,64 @@ def ComputeChanges(data, lam, alpha=0.7, groups=None, beta=1.0, lam_min=None,
                     max_t = world.bcast(max_t, 0)
                 if max_t != change_times[t+1]:
                     if max_t == change_times[t] or max_t == change_times[t+2]:
-                        for i, ind in enumerate(inds):
-                            if ind in changes[change_times[t+1]]:
-                                if ind in changes[max_t]:
-                                    changes_per_ind[i].pop(prev_change_ind[i]+1)
-                                    next_change_ind[i] -= 1
-                                else:
-                                    changes_per_ind[i][prev_change_ind[i]+1] \
-                                            = max_t
+                        present = changes[max_t].contains(inds)
+                        for i in np.flatnonzero(moving).tolist():
+                            if present[i]:
+                                changes_per_ind[i] = np.delete(
+                                    changes_per_ind[i], prev_change_ind[i]+1)
+                                next_change_ind[i] -= 1
+                            else:
+                                changes_per_ind[i][prev_change_ind[i]+1] = max_t
                         changes[max_t] |= changes.pop(change_times[t+1])
                         change_times.pop(t+1)
                         t -= 1
                     else:
                         changes[max_t] = changes.pop(change_times[t+1])
                         change_times[t+1] = max_t
-                        for i, ind in enumerate(inds):
-                            if ind in changes[max_t]:
-                                changes_per_ind[i][prev_change_ind[i]+1] = max_t
+                        for i in np.flatnonzero(moving).tolist():
+                            changes_per_ind[i][prev_change_ind[i]+1] = max_t
                 t += 1
         prev_nchange_times = len(changes)
-        changes.pop(0)
-        changes.pop(T)
+        # Without any time series left to solve, there are no boundaries
+        changes.pop(0, None)
+        changes.pop(T, None)
 
         if verbose and world_rank == 0:
             count = sum([len(changes[t]) for t in changes])
             _s = lambda _x: '' if _x == 1 else 's'
             print 'Iteration %d done, %d change time%s, %d change%s' % (iter,
                     len(changes), _s(len(changes)), count, _s(count))
+            print '...solved %d time series, skipped %d with unchanged ' \
+                    'penalties' % (nsolved, nskipped)
         if world_rank == 0:
-            change_history.append(changes)
-            finished = False
-            if len(changes) == 0:
-                finished = True
-            if iter > 0:
-                for old_changes in change_history[:-1]:
-                    if changes == old_changes:
-                        finished = True
+            # Stop when the changes repeat those of an earlier iteration,
+            # comparing them in full only when the fingerprints match
+            encoded = _encode_changes(changes)
+            fingerprint = hashlib.sha1(encoded).hexdigest()
+            repeat = None
+            for old_iter, old_encoded in history[fingerprint]:
+                if zlib.decompress(old_encoded) == encoded:
+                    repeat = old_iter
+                    break
+            history[fingerprint].append((iter, zlib.compress(encoded)))
+            diff = _change_diff(prev_changes, changes)
+            prev_changes = changes
+            finished = len(changes) == 0 or repeat is not None
+            if verbose:
+                print '...%d change times added, %d removed, %d moved, ' \
+                        '%d modified' % (diff['times_added'],
+                        diff['times_removed'], diff['times_moved'],
+                        diff['times_modified'])
+                if repeat is not None and repeat < iter - 1:
+                    print '...changes repeat those of iteration %d' % repeat
+            if iteration_info is not None:
+                info = {'iteration': iter,
+                        'solved': int(nsolved), 'skipped': int(nskipped),
+                        'change_times': len(changes),
+                        'changes': sum([len(changes[t]) for t in changes]),
+                        'fingerprint': fingerprint, 'repeat_of': repeat}
+                info.update(diff)
+                iteration_info.append(info)
         else:
             finished = None
         if parallel:
@@ -339,13 +892,16 @@ def ComputeChanges(data, lam, alpha=0.7, groups=None, beta=1.0, lam_min=None,
             print '...updating penalties'
 
         # Update penalties using new changes
-        changes_mat = scipy.sparse.lil_matrix((J, len(changes)), dtype=group_dtype)
-        change_times = changes.keys()
-        change_times.sort()
-        change_times = np.array(change_times)
-        for i, t in enumerate(change_times):
-            changes_mat[list(changes[t]), i] = 1
-        changes_mat = changes_mat.tocsc()
+        change_times = np.array(sorted(changes), dtype='int')
+        changed_inds = [changes[t].indices() for t in change_times]
+        change_rows = np.concatenate([np.zeros(0, dtype='int')]
+                + changed_inds).astype('int')
+        change_cols = np.repeat(np.arange(len(change_times)),
+                [len(c) for c in changed_inds])
+        changes_mat = scipy.sparse.csc_matrix(
+                (np.ones(len(change_rows), dtype=group_dtype),
+                 (change_rows, change_cols)),
+                shape=(J, len(change_times)))
         try:
             totals = groups_mat.dot(changes_mat)
         except MemoryError:
@@ -353,30 +909,69 @@ def ComputeChanges(data, lam, alpha=0.7, groups=None, beta=1.0, lam_min=None,
                     + ', ' + str(changes_mat.shape)
             raise
         if world_rank == 0:
-            dense_totals = totals.toarray()
-            current = (dense_totals**beta).sum(axis=0)
+            current = _power_sums(totals, beta)
         else:
             current = None
         if parallel:
             current = world.bcast(current, 0)
         # Reset penalties to the values they would take if there were no changes
         if len(inds) > 0:
-            for i, ind in enumerate(inds):
-                if not disabled[i]:
-                    penalties[i] = lam * (len(group_inds[i]))**alpha * \
-                            rands[i] / 0.9
-            cmat = np.asarray(changes_mat[inds,:].todense(), dtype='bool')
-            for i, ind in enumerate(inds):
-                if not disabled[i]:
-                    submat = totals[group_inds[i],:].toarray()
-                    cup = current + ((submat+1)**beta - submat**beta).sum(axis=0)
-                    cdown = current + (np.maximum(submat-1,0)**beta
-                            - submat**beta).sum(axis=0)
-                    cdown = np.maximum(cdown, 0)
-                    penalties[i, change_times - 1] = \
-                            lam * ((1-cmat[i]) * (cup**alpha - current**alpha) \
-                            + cmat[i] * (current**alpha - cdown**alpha))
+            _univariate_changes.jitter(penalties, keys, lam * np.array(
+                [len(g) for g in group_inds])**alpha / 0.9, 0.9, 1.0)
+            # Time series in the same groups share their marginal penalties
+            used, row_sig = np.unique(groups.signature[inds],
+                    return_inverse=True)
+            signatures = [groups.signatures[sig] for sig in used]
+            sig_rows = [[] for sig in used]
+            for i, sig in enumerate(row_sig.tolist()):
+                sig_rows[sig].append(i)
+            # Local time series that change at each change time
+            is_local = (change_rows % world_size) == world_rank
+            local_rows = local_pos[change_rows[is_local] / world_size]
+            local_cols = change_cols[is_local]
+            block_pos = np.zeros(len(signatures), dtype='int')
+            for block, up, down in _marginal_penalties(totals, current,
+                    signatures, lam, alpha, beta):
+                rows = [i for s in block for i in sig_rows[s]]
+                pos = np.repeat(np.arange(len(block)),
+                        [len(sig_rows[s]) for s in block])
+                penalties[np.ix_(rows, change_times - 1)] = up[pos]
+                block_pos[:] = -1
+                block_pos[block] = np.arange(len(block))
+                sel = block_pos[row_sig[local_rows]] >= 0
+                penalties[local_rows[sel], change_times[local_cols[sel]] - 1] = \
+                        down[block_pos[row_sig[local_rows[sel]]], local_cols[sel]]
 
     if verbose and world_rank == 0:
         print 'Iterations complete'
-    return dict(changes)
+    changes = dict((t, changes[t].to_set()) for t in changes)
+    if not return_segments:
+        return changes
+
+    # Fit the segments of the local time series between their final changes
+    local = dict((ind, i) for i, ind in enumerate(inds))
+    row_times = [[0] for ind in inds]
+    for t in sorted(changes):
+        for ind in changes[t]:
+            if ind in local:
+                row_times[local[ind]].append(t)
+    for times in row_times:
+        times.append(T)
+    row_segments = []
+    if len(inds) > 0:
+        row_segments = _fit_segments(data, ranks, shift, scale, row_times,
+                workspace, cost)
+    inds = inds + dropped_inds
+    row_segments = row_segments + dropped_segments
+    if parallel:
+        all_row_segments = world.gather((inds, row_segments), 0)
+    else:
+        all_row_segments = [(inds, row_segments)]
+    if world_rank != 0:
+        return changes, None
+    ordered = [None] * J
+    for node_inds, node_segments in all_row_segments:
+        for ind, row in zip(node_inds, node_segments):
+            ordered[ind] = row
+    offsets = np.cumsum([0] + [len(row) for row in ordered])
+    return changes, (offsets, np.concatenate(ordered))
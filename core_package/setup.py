@@ -11,6 +11,6 @@ setup(name='SIMPLEchangepoint',
         packages=['SIMPLEchangepoint'],
         platforms=['Linux'],
         ext_modules=[Extension('SIMPLEchangepoint._univariate_changes',
-            ['src/_univariate_changes.cpp'])],
+            ['src/_univariate_changes.cpp'], libraries=['pthread'])],
         scripts=['scripts/ComputeSIMPLEChanges']
         )
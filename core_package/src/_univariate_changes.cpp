@@ -30,205 +30,2594 @@ THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
 OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 */
 #include <Python.h>
+#include <structmember.h>
 #include <numpy/arrayobject.h>
 #include <assert.h>
 #include <math.h>
+#include <string.h>
 #include <stdlib.h>
-#include <queue>
-#include <list>
+#include <unistd.h>
+#include <pthread.h>
+#include <time.h>
 #include <string>
 #include <iostream>
 #include <limits>
+#include <vector>
+#include <algorithm>
 
 const int MIN_SEP = 2;
 
-struct SuffStat {
-    SuffStat(int _t) : t(_t), n(0), med(0), total_var(0), cost(0), prune_t(-1) {}
+static double laplace_ll(int n, double total_var) {
+    if (total_var <= 0 || n < MIN_SEP)
+        return -std::numeric_limits<double>::infinity();
+    else
+        return -n * (1 + log(2 * total_var / n));
+}
 
-    void add(double x) {
-        ++n;
-        if (highs.size() == lows.size()) {
-            if (highs.size() == 0 || x < highs.top()) {
-                lows.push(x);
-                med = lows.top();
-                total_var += med - x;
-            } else {
-                highs.push(x);
-                med = highs.top();
-                total_var += x - med;
-            }
-        } else if (highs.size() < lows.size()) {
-            if (x >= lows.top()) {
-                highs.push(x);
-                med = (lows.top() + highs.top()) / 2;
-                total_var += (highs.top() - lows.top()) / 2;
-                total_var += x - med;
+// One row of float32 or float64 values `stride` bytes apart, read in place
+// from the caller's array
+struct RowData {
+    RowData() : ptr(NULL), stride(0), is_double(false) {}
+    RowData(const char* _ptr, npy_intp _stride, bool _is_double)
+        : ptr(_ptr), stride(_stride), is_double(_is_double) {}
+
+    double operator[](npy_intp i) const {
+        const char* p = ptr + i * stride;
+        return is_double ? *(const double*) p : *(const float*) p;
+    }
+
+    RowData operator+(npy_intp i) const {
+        return RowData(ptr + i * stride, stride, is_double);
+    }
+
+    const char* ptr;
+    npy_intp stride;
+    bool is_double;
+};
+
+// The rows of a 1- or 2-dimensional array of data, row_stride bytes apart
+struct DataRows {
+    RowData row(npy_intp i) const {
+        return RowData(ptr + i * row_stride, stride, is_double);
+    }
+
+    const char* ptr;
+    npy_intp row_stride;
+    npy_intp stride;
+    bool is_double;
+};
+
+struct RankLess {
+    RankLess(const RowData& _data) : data(_data) {}
+    bool operator()(int a, int b) const {
+        return data[a] < data[b] || (data[a] == data[b] && a < b);
+    }
+    RowData data;
+};
+
+struct KeyLess {
+    KeyLess(const npy_int32* _keys) : keys(_keys) {}
+    bool operator()(int a, int b) const {
+        return keys[a] < keys[b];
+    }
+    const npy_int32* keys;
+};
+
+// Wavelet matrix over the ranks of one row of data. Answers order-statistic
+// queries (k-th smallest value, sum of the k smallest values) on any interval
+// [s, t) in O(log T) time using O(T log T) memory, so that the median and
+// total absolute deviation of a segment need not be maintained incrementally.
+struct IntervalIndex {
+    IntervalIndex() : T(0), levels(0) {}
+
+    // If given, data_ranks holds the ranks of the values as computed by
+    // compute_ranks() (or of a larger row containing them), which saves
+    // sorting the values again.
+    void build(const RowData& data, int _T, const npy_int32* data_ranks = NULL) {
+        T = _T;
+        levels = 1;
+        while ((1 << levels) < T)
+            ++levels;
+        order.resize(T);
+        bool placed = false;
+        if (data_ranks != NULL) {
+            std::fill(order.begin(), order.end(), -1);
+            placed = true;
+            for (int i = 0; i < T && placed; ++i) {
+                int r = data_ranks[i];
+                if (r < 0 || r >= T || order[r] >= 0)
+                    placed = false;
+                else
+                    order[r] = i;
+            }
+        }
+        if (!placed) {
+            for (int i = 0; i < T; ++i)
+                order[i] = i;
+            if (data_ranks != NULL)
+                std::sort(order.begin(), order.end(), KeyLess(data_ranks));
+            else
+                std::sort(order.begin(), order.end(), RankLess(data));
+        }
+        ranks.resize(T);
+        sorted.resize(T);
+        for (int k = 0; k < T; ++k) {
+            ranks[order[k]] = k;
+            sorted[k] = data[order[k]];
+        }
+        sums.resize(T + 1);
+        sums[0] = 0;
+        for (int i = 0; i < T; ++i)
+            sums[i+1] = sums[i] + data[i];
+        run_end.resize(T);
+        for (int i = T - 1; i >= 0; --i)
+            run_end[i] = (i < T - 1 && data[i] == data[i+1]) ? run_end[i+1] : i + 1;
+        ones.resize(levels * (T + 1));
+        zero_sums.resize(levels * (T + 1));
+        zeros.resize(levels);
+        next.resize(T);
+        for (int l = 0; l < levels; ++l) {
+            int bit = levels - 1 - l;
+            int* o = &ones[l * (T + 1)];
+            double* zs = &zero_sums[l * (T + 1)];
+            o[0] = 0;
+            zs[0] = 0;
+            int nz = 0;
+            for (int i = 0; i < T; ++i) {
+                int b = (ranks[i] >> bit) & 1;
+                o[i+1] = o[i] + b;
+                zs[i+1] = zs[i] + (b ? 0 : sorted[ranks[i]]);
+                if (!b)
+                    next[nz++] = ranks[i];
+            }
+            zeros[l] = nz;
+            for (int i = 0, j = nz; i < T; ++i)
+                if ((ranks[i] >> bit) & 1)
+                    next[j++] = ranks[i];
+            ranks.swap(next);
+        }
+    }
+
+    // Sum of the k smallest values in [s, t)
+    double sum_smallest(int s, int t, int k) const {
+        double total = 0;
+        for (int l = 0; l < levels && k > 0; ++l) {
+            const int* o = &ones[l * (T + 1)];
+            int z = (t - s) - (o[t] - o[s]);
+            if (k >= z) {
+                const double* zs = &zero_sums[l * (T + 1)];
+                total += zs[t] - zs[s];
+                k -= z;
+                s = zeros[l] + o[s];
+                t = zeros[l] + o[t];
             } else {
-                highs.push(lows.top());
-                lows.pop();
-                lows.push(x);
-                med = (lows.top() + highs.top()) / 2;
-                total_var += (highs.top() - lows.top()) / 2;
-                total_var += med - x;
+                s -= o[s];
+                t -= o[t];
             }
-        } else {
-            if (x <= highs.top()) {
-                lows.push(x);
-                med = (lows.top() + highs.top()) / 2;
-                total_var += (highs.top() - lows.top()) / 2;
-                total_var += med - x;
+        }
+        if (k > 0)
+            total += sorted[s];
+        return total;
+    }
+
+    // k-th smallest value (counting from 0) in [s, t); its rank is read off
+    // the bits of the path taken through the levels
+    double kth(int s, int t, int k) const {
+        int rank = 0;
+        for (int l = 0; l < levels; ++l) {
+            const int* o = &ones[l * (T + 1)];
+            int z = (t - s) - (o[t] - o[s]);
+            rank <<= 1;
+            if (k >= z) {
+                k -= z;
+                s = zeros[l] + o[s];
+                t = zeros[l] + o[t];
+                rank |= 1;
             } else {
-                lows.push(highs.top());
-                highs.pop();
-                highs.push(x);
-                med = (lows.top() + highs.top()) / 2;
-                total_var += (highs.top() - lows.top()) / 2;
-                total_var += x - med;
+                s -= o[s];
+                t -= o[t];
             }
         }
+        return sorted[rank];
+    }
+
+    double median(int s, int t) const {
+        int n = t - s;
+        if (n % 2)
+            return kth(s, t, n / 2);
+        return (kth(s, t, n / 2 - 1) + kth(s, t, n / 2)) / 2;
+    }
+
+    // Sum of absolute deviations from the median over [s, t)
+    double total_var(int s, int t) const {
+        if (run_end[s] >= t)
+            return 0;
+        int n = t - s;
+        int h = n / 2;
+        double total_var = (sums[t] - sums[s]) - sum_smallest(s, t, n - h)
+            - sum_smallest(s, t, h);
+        return total_var > 0 ? total_var : 0;
+    }
+
+    double ll(int s, int t) const {
+        return laplace_ll(t - s, total_var(s, t));
+    }
+
+    int T;
+    int levels;
+    std::vector<int> ones;
+    std::vector<double> zero_sums;
+    std::vector<int> zeros;
+    std::vector<double> sorted;
+    std::vector<double> sums;
+    std::vector<int> run_end;
+    // Scratch space, kept so that rebuilding the index does not reallocate
+    std::vector<int> order;
+    std::vector<int> ranks;
+    std::vector<int> next;
+};
+
+enum CostModel {
+    COST_LAPLACE,
+    COST_NORMAL_MEAN,
+    COST_NORMAL_VAR,
+    COST_BERNOULLI
+};
+
+static bool parse_cost(const char* name, CostModel* model) {
+    if (name == NULL || strcmp(name, "laplace") == 0)
+        *model = COST_LAPLACE;
+    else if (strcmp(name, "normal_mean") == 0)
+        *model = COST_NORMAL_MEAN;
+    else if (strcmp(name, "normal_var") == 0)
+        *model = COST_NORMAL_VAR;
+    else if (strcmp(name, "bernoulli") == 0)
+        *model = COST_BERNOULLI;
+    else {
+        PyErr_Format(PyExc_ValueError, "Unknown cost '%s'; expected 'laplace', 'normal_mean', 'normal_var' or 'bernoulli'", name);
+        return false;
+    }
+    return true;
+}
+
+// Number of set bits among the first n (0 <= n < 8) bits of a byte packed
+// most significant bit first, as by numpy.packbits
+static inline int leading_ones(npy_uint8 byte, int n) {
+    return __builtin_popcount(byte >> (8 - n));
+}
+
+// Maximized log-likelihood of any segment [s, t) of one row under a cost
+// model: iid Laplace with free location and scale (using IntervalIndex),
+// Normal with free mean and unit variance ('normal_mean') or with zero mean
+// and free variance ('normal_var'), both in O(1) from cumulative sums, or
+// Bernoulli with free success probability ('bernoulli') in O(1) from
+// popcounts of bit-packed values.
+struct SegmentCost {
+    SegmentCost() : model(COST_LAPLACE) {}
+
+    // For the Bernoulli cost, values above 0.5 count as successes
+    void build(CostModel _model, const RowData& data, int T,
+            const npy_int32* ranks = NULL) {
+        model = _model;
+        if (model == COST_LAPLACE) {
+            index.build(data, T, ranks);
+            return;
+        }
+        if (model == COST_BERNOULLI) {
+            packed.assign((T + 7) / 8, 0);
+            for (int i = 0; i < T; ++i)
+                if (data[i] > 0.5)
+                    packed[i / 8] |= 0x80 >> (i % 8);
+            build_bits(packed.empty() ? NULL : &packed[0], 0, T);
+            return;
+        }
+        // Center on the first value to limit cancellation in the sums
+        center = (model == COST_NORMAL_MEAN && T > 0) ? data[0] : 0;
+        s1.resize(T + 1);
+        s2.resize(T + 1);
+        s1[0] = s2[0] = 0;
+        for (int i = 0; i < T; ++i) {
+            double x = data[i] - center;
+            s1[i+1] = s1[i] + x;
+            s2[i+1] = s2[i] + x * x;
+        }
+    }
+
+    // Bernoulli cost over the T bits starting at bit `offset` of a packed row.
+    // Only the ones in every byte are counted up front; the count up to any
+    // bit is then one more popcount.
+    void build_bits(const npy_uint8* _bits, int offset, int T) {
+        model = COST_BERNOULLI;
+        bits = _bits + offset / 8;
+        bit_offset = offset % 8;
+        int nbytes = (bit_offset + T + 7) / 8;
+        byte_ones.resize(nbytes + 1);
+        byte_ones[0] = 0;
+        for (int k = 0; k < nbytes; ++k)
+            byte_ones[k+1] = byte_ones[k] + __builtin_popcount(bits[k]);
+        first_ones = bit_offset ? leading_ones(bits[0], bit_offset) : 0;
     }
 
-    double ll() {
-        if (total_var == 0 || n < MIN_SEP)
+    // Number of ones among the first i values
+    int ones(int i) const {
+        int b = bit_offset + i;
+        int partial = (b % 8) ? leading_ones(bits[b / 8], b % 8) : 0;
+        return byte_ones[b / 8] + partial - first_ones;
+    }
+
+    double ll(int s, int t) const {
+        int n = t - s;
+        if (model == COST_LAPLACE)
+            return index.ll(s, t);
+        if (n < MIN_SEP)
             return -std::numeric_limits<double>::infinity();
+        if (model == COST_BERNOULLI) {
+            int n1 = ones(t) - ones(s);
+            int n0 = n - n1;
+            double val = 0;
+            if (n1 > 0)
+                val += n1 * log((double) n1 / n);
+            if (n0 > 0)
+                val += n0 * log((double) n0 / n);
+            return val;
+        }
+        double sum_sq = s2[t] - s2[s];
+        if (model == COST_NORMAL_MEAN) {
+            double sum = s1[t] - s1[s];
+            double var = sum_sq - sum * sum / n;
+            return -0.5 * (n * log(2 * M_PI) + (var > 0 ? var : 0));
+        }
+        if (sum_sq <= 0)
+            return -std::numeric_limits<double>::infinity();
+        return -0.5 * n * (1 + log(2 * M_PI * sum_sq / n));
+    }
+
+    // Fitted location and scale of segment [s, t), s < t: the median and
+    // mean absolute deviation for the Laplace cost, the mean (0 for
+    // normal_var) and standard deviation for the Normal costs, and the
+    // fraction of ones and its standard deviation for the Bernoulli cost.
+    void fit(int s, int t, double* location, double* scale) const {
+        int n = t - s;
+        if (model == COST_LAPLACE) {
+            *location = index.median(s, t);
+            *scale = index.total_var(s, t) / n;
+        } else if (model == COST_BERNOULLI) {
+            double p = (double) (ones(t) - ones(s)) / n;
+            *location = p;
+            *scale = sqrt(p * (1 - p));
+        } else if (model == COST_NORMAL_MEAN) {
+            double sum = s1[t] - s1[s];
+            double var = (s2[t] - s2[s]) - sum * sum / n;
+            *location = center + sum / n;
+            *scale = sqrt((var > 0 ? var : 0) / n);
+        } else {
+            *location = 0;
+            *scale = sqrt((s2[t] - s2[s]) / n);
+        }
+    }
+
+    CostModel model;
+    IntervalIndex index;
+    double center;
+    std::vector<double> s1;
+    std::vector<double> s2;
+    const npy_uint8* bits;
+    int bit_offset;
+    int first_ones;
+    std::vector<int> byte_ones;
+    std::vector<npy_uint8> packed;
+};
+
+// Candidate changes of the row solver in increasing order of t, stored as
+// parallel arrays so that their values can be computed by vectorized loops.
+// base is the value of the best segmentation before t less the penalty of a
+// change at t; cost is the value at the last time the candidate was
+// evaluated, or +inf if it has not been evaluated yet.
+struct CandidateSet {
+    void clear() { t.clear(); base.clear(); cost.clear(); prune_t.clear(); }
+
+    void reserve(int T) {
+        t.reserve(T);
+        base.reserve(T);
+        cost.reserve(T);
+        prune_t.reserve(T);
+    }
+
+    size_t size() const { return t.size(); }
+
+    void push_back(int _t, double _base) {
+        t.push_back(_t);
+        base.push_back(_base);
+        cost.push_back(std::numeric_limits<double>::infinity());
+        prune_t.push_back(-1);
+    }
+
+    void move(size_t from, size_t to) {
+        t[to] = t[from];
+        base[to] = base[from];
+        cost[to] = cost[from];
+        prune_t[to] = prune_t[from];
+    }
+
+    void resize(size_t n) {
+        t.resize(n);
+        base.resize(n);
+        cost.resize(n);
+        prune_t.resize(n);
+    }
+
+    std::vector<int> t;
+    std::vector<double> base;
+    std::vector<double> cost;
+    std::vector<int> prune_t;
+};
+
+// Functions with an inner loop worth vectorizing are compiled for several
+// x86 instruction sets, and the best one the CPU supports is picked at load
+// time. Contraction to FMA is disabled so that all versions round alike.
+#if defined(__GNUC__) && !defined(__clang__) && defined(__x86_64__) \
+        && defined(__linux__)
+#define VECTOR_CLONES __attribute__((target_clones("default", "avx2", "avx512f"), \
+            optimize("fp-contract=off")))
+#else
+#define VECTOR_CLONES
+#endif
+
+// cost[k] = base[k] + ll(t[k], end) for the first n candidates under the
+// normal_mean cost with prefix sums s1, s2; as SegmentCost::ll, but without
+// its branches so the loop vectorizes. All segments must have length at
+// least MIN_SEP.
+VECTOR_CLONES
+static void normal_mean_costs(CandidateSet& checks, size_t n,
+        const double* s1, const double* s2, int end) {
+    const int* t = &checks.t[0];
+    const double* base = &checks.base[0];
+    double* cost = &checks.cost[0];
+    const double log_2pi = log(2 * M_PI);
+    double sum_end = s1[end];
+    double sum_sq_end = s2[end];
+    for (size_t k = 0; k < n; ++k) {
+        double len = end - t[k];
+        double sum = sum_end - s1[t[k]];
+        double var = (sum_sq_end - s2[t[k]]) - sum * sum / len;
+        cost[k] = -0.5 * (len * log_2pi + (var > 0 ? var : 0)) + base[k];
+    }
+}
+
+// Counters of the last call to solve_row on a workspace
+struct SolveStats {
+    void clear() { steps = 0; live = 0; max_live = 0; prunes = 0; seconds = 0; }
+    // Fills mean and max live candidates per time, prunes and wall time
+    void fill(double* out) const {
+        out[0] = steps > 0 ? live / (double) steps : 0;
+        out[1] = max_live;
+        out[2] = prunes;
+        out[3] = seconds;
+    }
+
+    long steps;
+    long live;
+    long max_live;
+    long prunes;
+    double seconds;
+};
+
+static double wall_time() {
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return ts.tv_sec + 1e-9 * ts.tv_nsec;
+}
+
+// Buffers for the row solver and ll_difference, reused across rows and
+// iterations to avoid reallocating them on every call.
+struct KernelWorkspace {
+    KernelWorkspace() : window_row(NULL) {}
+
+    void reserve(int T) {
+        vals.reserve(T);
+        prev.reserve(T);
+        checks.reserve(T);
+    }
+
+    SegmentCost cost;
+    std::vector<double> vals;
+    std::vector<int> prev;
+    CandidateSet checks;
+    std::vector<int> changes;
+    // Buffers of resume_costs
+    std::vector<int> set_at;
+    std::vector<int> nlive;
+    std::vector<int> dirty;
+    std::vector<float> scaled;
+    // Buffer of drop_forced
+    std::vector<npy_int32> forced;
+    SolveStats stats;
+    // Row and window [window_prev, window_next) that cost was last built
+    // for by ll_difference_row, or NULL if built for anything else
+    const void* window_row;
+    int window_prev;
+    int window_next;
+};
+
+// Sets the cost of the first ready candidates in ws.checks to their value
+// for a segment ending at end, and the cost of the rest to +inf so that they
+// are never pruned for being too short.
+static inline void evaluate_checks(KernelWorkspace& ws, size_t ready, int end) {
+    const SegmentCost& cost = ws.cost;
+    CandidateSet& checks = ws.checks;
+    if (cost.model == COST_NORMAL_MEAN && ready > 0) {
+        normal_mean_costs(checks, ready, &cost.s1[0], &cost.s2[0], end);
+    } else {
+        for (size_t k = 0; k < ready; ++k)
+            checks.cost[k] = cost.ll(checks.t[k], end) + checks.base[k];
+    }
+    for (size_t k = ready; k < checks.size(); ++k)
+        checks.cost[k] = std::numeric_limits<double>::infinity();
+}
+
+// One time t of the row solver: drops the candidates in ws.checks that
+// were pruned or are too far back, evaluates the rest, and sets vals[t] and
+// prev[t]. Candidates valued below threshold at the previous time are pruned
+// at prune_at; if set_at is given, set_at[s] records the time at which the
+// candidate s was marked for pruning.
+static inline void solve_step(KernelWorkspace& ws, int t, int max_len,
+        double threshold, int prune_at, int* set_at = NULL) {
+    CandidateSet& checks = ws.checks;
+    SolveStats& stats = ws.stats;
+    // Drop pruned candidates and those too far back; the rest are ready,
+    // except that restricted candidates may be added before their first
+    // segment is long enough, which the order of t puts last
+    size_t live = 0;
+    size_t ready = 0;
+    for (size_t k = 0; k < checks.size(); ++k) {
+        int prune_t = checks.prune_t[k];
+        if (prune_t == -1 && checks.cost[k] < threshold) {
+            prune_t = checks.prune_t[k] = prune_at;
+            if (set_at != NULL)
+                set_at[checks.t[k]] = t;
+        }
+        if (prune_t >= 0 && prune_t <= t) {
+            ++stats.prunes;
+            continue;
+        }
+        if (max_len > 0 && t + 1 - checks.t[k] > max_len)
+            continue;
+        if (checks.t[k] + MIN_SEP <= t + 1)
+            ++ready;
+        checks.move(k, live++);
+    }
+    checks.resize(live);
+    evaluate_checks(ws, ready, t + 1);
+    double max_val = -std::numeric_limits<double>::max();
+    int max_ind = -1;
+    for (size_t k = 0; k < ready; ++k) {
+        if (checks.cost[k] > max_val) {
+            max_val = checks.cost[k];
+            max_ind = checks.t[k];
+        }
+    }
+    ++stats.steps;
+    stats.live += live;
+    stats.max_live = std::max(stats.max_live, (long) live);
+    ws.vals[t] = max_val;
+    ws.prev[t] = max_ind;
+}
+
+// Sets ws.changes from the optimal previous changes prev of a row
+static void backtrack(std::vector<int>& changes, const std::vector<int>& prev,
+        int T) {
+    changes.clear();
+    int ind = prev[T-1];
+    while (ind > 1) {
+        changes.push_back(ind);
+        ind = prev[ind-1];
+    }
+    std::reverse(changes.begin(), changes.end());
+}
+
+// Univariate dynamic programming algorithm for one row whose costs ws.cost
+// have already been built. If ncands >= 0, changes are restricted to the
+// ncands increasing times in cands, and the optimum is only computed just
+// before each of them and at the end of the row. If max_len > 0, segments
+// longer than max_len are not considered, which bounds the number of live
+// candidates by max_len (see drop_forced for the changes this forces). The
+// changes are left in ws.changes, and the candidate counters are added to
+// ws.stats.
+//
+// A candidate s whose value at t falls below vals[t] - penalties[t] can
+// never again beat a change at t+1, since splitting a segment never lowers
+// its log-likelihood; it is dropped once segments starting at t+1 reach
+// MIN_SEP. That test uses the exact penalty at t, so no bound built from
+// smaller penalties (e.g. their minimum) can prune more without losing
+// exactness. The test for time t is made when the candidates are compacted
+// at the next time.
+static void solve_costs(KernelWorkspace& ws, const float* penalties, int T,
+        const npy_int32* cands = NULL, int ncands = -1, int max_len = 0) {
+    ws.changes.clear();
+    if (T < MIN_SEP)
+        return;
+    std::vector<double>& vals = ws.vals;
+    vals.resize(T);
+    ws.prev.resize(T);
+    CandidateSet& checks = ws.checks;
+    checks.clear();
+    checks.push_back(0, 0);
+    int next_cand = 0;
+    double threshold = -std::numeric_limits<double>::infinity();
+    int prune_at = -1;
+    for (int t = MIN_SEP - 1; t < T; ++t) {
+        if (ncands >= 0) {
+            while (next_cand < ncands && cands[next_cand] <= t)
+                ++next_cand;
+            t = next_cand < ncands ? cands[next_cand] - 1 : T - 1;
+        }
+        solve_step(ws, t, max_len, threshold, prune_at);
+        if (t < T-1) {
+            threshold = vals[t] - penalties[t];
+            prune_at = t + MIN_SEP;
+        }
+        if (ncands >= 0) {
+            if (next_cand < ncands)
+                checks.push_back(cands[next_cand], vals[t] - penalties[t]);
+        } else if (t - MIN_SEP + 2 >= MIN_SEP)
+            checks.push_back(t - MIN_SEP + 2,
+                    vals[t - MIN_SEP + 1] - penalties[t - MIN_SEP + 1]);
+    }
+    backtrack(ws.changes, ws.prev, T);
+}
+
+// Solver arrays of a row from its last solution by resume_costs: the
+// penalties, vals and prev, the time set_at[s] at which each candidate s was
+// marked for pruning (or -1), and the number nlive[t] of candidates after
+// each time t. T is -1 if there is none.
+struct RowState {
+    RowState() : T(-1) {}
+
+    int T;
+    int max_len;
+    CostModel model;
+    std::vector<float> penalties;
+    std::vector<double> vals;
+    std::vector<int> prev;
+    std::vector<int> set_at;
+    std::vector<int> nlive;
+};
+
+// Rebuilds ws.checks as they were after time r-1 (or initially, for
+// r = MIN_SEP-1) from the arrays of a solution that is valid up to r-1, and
+// sets the threshold and prune_at for time r.
+static void restore_checks(KernelWorkspace& ws, const float* penalties,
+        int r, int max_len, double* threshold, int* prune_at) {
+    CandidateSet& checks = ws.checks;
+    checks.clear();
+    if (r < MIN_SEP) {
+        checks.push_back(0, 0);
+        ws.set_at[0] = -1;
+        *threshold = -std::numeric_limits<double>::infinity();
+        *prune_at = -1;
+        return;
+    }
+    // Scan back from the last candidate added for the live ones
+    std::vector<int>& found = ws.changes;
+    found.clear();
+    int count = ws.nlive[r-1];
+    for (int s = r - MIN_SEP + 1; count > 0 && s >= 0; --s) {
+        if (s > 0 && s < MIN_SEP)
+            continue;
+        int set = ws.set_at[s];
+        if (set > r - 1)
+            set = ws.set_at[s] = -1;
+        int removed = set >= 0 ? set + MIN_SEP - 1 : std::numeric_limits<int>::max();
+        if (max_len > 0)
+            removed = std::min(removed, s + max_len);
+        if (removed <= r - 1)
+            continue;
+        found.push_back(s);
+        --count;
+    }
+    size_t ready = 0;
+    for (size_t k = found.size(); k-- > 0; ) {
+        int s = found[k];
+        checks.push_back(s, s == 0 ? 0 : ws.vals[s-1] - penalties[s-1]);
+        if (ws.set_at[s] >= 0)
+            checks.prune_t.back() = ws.set_at[s] + MIN_SEP - 1;
+        if (s + MIN_SEP <= r)
+            ++ready;
+    }
+    evaluate_checks(ws, ready, r);
+    *threshold = ws.vals[r-1] - penalties[r-1];
+    *prune_at = r - 1 + MIN_SEP;
+}
+
+// Whether ws.checks after time t and the threshold for t+1 equal those of
+// the last solution in st, so that the solver repeats it from t+1 on until
+// it reads a changed penalty.
+static bool same_checks(const KernelWorkspace& ws, const RowState& st,
+        const float* penalties, int t) {
+    const CandidateSet& checks = ws.checks;
+    if (checks.size() != (size_t) st.nlive[t])
+        return false;
+    if (ws.vals[t] - penalties[t] != st.vals[t] - st.penalties[t])
+        return false;
+    for (size_t k = 0; k < checks.size(); ++k) {
+        int s = checks.t[k];
+        int set = st.set_at[s];
+        int prune_t = set >= 0 && set <= t ? set + MIN_SEP - 1 : -1;
+        if (checks.prune_t[k] != prune_t)
+            return false;
+        if (s > 0 && checks.base[k] != st.vals[s-1] - st.penalties[s-1])
+            return false;
+    }
+    return true;
+}
+
+// As solve_costs without restricted candidates, but starting from the last
+// solution of the row in st, which is replaced by the new one. Penalty
+// penalties[p] is only read at times p and p+MIN_SEP-1, so the solver is
+// restarted from its saved candidates at each such time for a changed
+// penalty, and stops as soon as its candidates again equal those of the last
+// solution, whose values it then keeps up to the next such time. The
+// arithmetic is that of solve_costs, so the changes are identical to those
+// of a full solve.
+static void resume_costs(KernelWorkspace& ws, RowState& st,
+        const float* penalties, int T, int max_len) {
+    ws.changes.clear();
+    if (T < MIN_SEP)
+        return;
+    bool fresh = st.T != T || st.max_len != max_len || st.model != ws.cost.model;
+    std::vector<int>& dirty = ws.dirty;
+    dirty.clear();
+    if (fresh) {
+        dirty.push_back(MIN_SEP - 1);
+        ws.vals.resize(T);
+        ws.prev.resize(T);
+        ws.set_at.assign(T, -1);
+        ws.nlive.resize(T);
+    } else {
+        for (int p = 0; p < T - 1; ++p) {
+            if (penalties[p] != st.penalties[p]) {
+                if (p >= MIN_SEP - 1)
+                    dirty.push_back(p);
+                if (p + MIN_SEP - 1 < T)
+                    dirty.push_back(p + MIN_SEP - 1);
+            }
+        }
+        std::sort(dirty.begin(), dirty.end());
+        dirty.erase(std::unique(dirty.begin(), dirty.end()), dirty.end());
+        ws.vals = st.vals;
+        ws.prev = st.prev;
+        ws.set_at = st.set_at;
+        ws.nlive = st.nlive;
+    }
+    std::vector<double>& vals = ws.vals;
+    CandidateSet& checks = ws.checks;
+    size_t next = 0;
+    while (next < dirty.size()) {
+        double threshold;
+        int prune_at;
+        restore_checks(ws, penalties, dirty[next], max_len, &threshold,
+                &prune_at);
+        int t;
+        for (t = dirty[next]; t < T; ++t) {
+            solve_step(ws, t, max_len, threshold, prune_at, &ws.set_at[0]);
+            if (t < T-1) {
+                threshold = vals[t] - penalties[t];
+                prune_at = t + MIN_SEP;
+            }
+            if (t - MIN_SEP + 2 >= MIN_SEP) {
+                checks.push_back(t - MIN_SEP + 2,
+                        vals[t - MIN_SEP + 1] - penalties[t - MIN_SEP + 1]);
+                ws.set_at[t - MIN_SEP + 2] = -1;
+            }
+            ws.nlive[t] = checks.size();
+            while (next < dirty.size() && dirty[next] <= t)
+                ++next;
+            if (fresh || t == T-1 || (next < dirty.size() && dirty[next] == t+1))
+                continue;
+            if (same_checks(ws, st, penalties, t))
+                break;
+        }
+        if (t >= T)
+            break;
+        // The live candidates are next marked when they were last time
+        for (size_t k = 0; k < checks.size(); ++k)
+            ws.set_at[checks.t[k]] = st.set_at[checks.t[k]];
+    }
+    backtrack(ws.changes, ws.prev, T);
+    st.T = T;
+    st.max_len = max_len;
+    st.model = ws.cost.model;
+    st.penalties.assign(penalties, penalties + T - 1);
+    st.vals.swap(ws.vals);
+    st.prev.swap(ws.prev);
+    st.set_at.swap(ws.set_at);
+    st.nlive.swap(ws.nlive);
+}
+
+static void build_costs(KernelWorkspace& ws, const RowData& data, int T,
+        const npy_int32* ranks, CostModel model, const npy_uint8* bits) {
+    ws.window_row = NULL;
+    if (bits != NULL)
+        ws.cost.build_bits(bits, 0, T);
+    else
+        ws.cost.build(model, data, T, ranks);
+}
+
+// Binary segmentation of one row whose costs ws.cost have already been
+// built: a segment is split at the change that most increases the
+// log-likelihood less its penalty, as long as that increase is positive (or
+// the segment is longer than max_len > 0; see drop_forced), and both halves
+// are split in turn. Each level of splits costs O(T) segment costs, so
+// balanced splits take O(T log T) of them, against the O(T) per time of the
+// DP when pruning fails; the changes are not optimal. They are left in
+// ws.changes.
+static void solve_binseg(KernelWorkspace& ws, const float* penalties, int T,
+        int max_len = 0) {
+    std::vector<int>& changes = ws.changes;
+    changes.clear();
+    const SegmentCost& cost = ws.cost;
+    std::vector<std::pair<int, int> > segments(1, std::make_pair(0, T));
+    while (!segments.empty()) {
+        int s = segments.back().first;
+        int t = segments.back().second;
+        segments.pop_back();
+        if (t - s < 2 * MIN_SEP)
+            continue;
+        double best = -std::numeric_limits<double>::infinity();
+        int best_u = -1;
+        for (int u = s + MIN_SEP; u <= t - MIN_SEP; ++u) {
+            double val = cost.ll(s, u) + cost.ll(u, t) - penalties[u - 1];
+            if (val > best) {
+                best = val;
+                best_u = u;
+            }
+        }
+        bool too_long = max_len > 0 && t - s > max_len;
+        if (too_long && best_u < 0)
+            best_u = s + (t - s) / 2;
+        else if (best_u < 0 || (!too_long && !(best - cost.ll(s, t) > 0)))
+            continue;
+        changes.push_back(best_u);
+        segments.push_back(std::make_pair(s, best_u));
+        segments.push_back(std::make_pair(best_u, t));
+    }
+    std::sort(changes.begin(), changes.end());
+}
+
+// With max_len > 0, the solvers cut every segment longer than max_len even
+// where nothing changes. Keeps the subset of ws.changes that is optimal
+// without max_len, found by the DP restricted to them, which drops the
+// changes made only to cut such segments (and leaves the optimal changes
+// without max_len as they are); the segments between the changes kept may be
+// longer than max_len. Restricted to the changes, the DP costs O(n) segment
+// costs per change for n changes, rather than per time.
+static void drop_forced(KernelWorkspace& ws, const float* penalties, int T) {
+    if (ws.changes.empty())
+        return;
+    std::vector<npy_int32>& forced = ws.forced;
+    forced.assign(ws.changes.begin(), ws.changes.end());
+    solve_costs(ws, penalties, T, &forced[0], forced.size());
+}
+
+// Univariate dynamic programming algorithm for one row, given either as
+// float values or, for the Bernoulli cost, as packed bits; see solve_costs.
+// With binseg, binary segmentation is used instead; see solve_binseg. With
+// a RowState, the last solution of the row saved there is resumed; see
+// resume_costs. With max_len > 0, the changes are then passed through
+// drop_forced.
+// Does not touch the Python API, so it may run with the GIL released; throws
+// std::bad_alloc if memory runs out. The changes are left in ws.changes.
+static void solve_row(KernelWorkspace& ws, const RowData& data,
+        const float* penalties, int T, const npy_int32* ranks = NULL,
+        CostModel model = COST_LAPLACE, const npy_uint8* bits = NULL,
+        const npy_int32* cands = NULL, int ncands = -1, int max_len = 0,
+        bool binseg = false, RowState* state = NULL) {
+    double start = wall_time();
+    ws.stats.clear();
+    if (T < MIN_SEP) {
+        ws.changes.clear();
+        return;
+    }
+    build_costs(ws, data, T, ranks, model, bits);
+    if (binseg)
+        solve_binseg(ws, penalties, T, max_len);
+    else if (state != NULL)
+        resume_costs(ws, *state, penalties, T, max_len);
+    else
+        solve_costs(ws, penalties, T, cands, ncands, max_len);
+    if (max_len > 0)
+        drop_forced(ws, penalties, T);
+    ws.stats.seconds = wall_time() - start;
+}
+
+// Location, scale and log-likelihood (see SegmentCost::fit) of each segment
+// between consecutive times of `times` (including 0 and T) under costs
+// built for the whole row; out receives ntimes-1 rows of 3 values.
+template <typename Time>
+static void fit_segments(const SegmentCost& cost, const Time* times,
+        size_t ntimes, double* out) {
+    for (size_t k = 0; k + 1 < ntimes; ++k) {
+        cost.fit(times[k], times[k+1], out + 3 * k, out + 3 * k + 1);
+        out[3 * k + 2] = cost.ll(times[k], times[k+1]);
+    }
+}
+
+struct PathSegmentation {
+    double scale;
+    double ll;
+    double penalty;
+    std::vector<int> changes;
+};
+
+static bool less_penalized(const PathSegmentation& a, const PathSegmentation& b) {
+    return a.penalty < b.penalty;
+}
+
+// Solves one row for the penalties base*scale and records the segmentation
+// in `found` unless already there; returns its index.
+static size_t solve_scaled(KernelWorkspace& ws, const float* base, int T,
+        double scale, int max_len, std::vector<PathSegmentation>& found) {
+    std::vector<float>& scaled = ws.scaled;
+    scaled.resize(T - 1);
+    for (int i = 0; i < T - 1; ++i)
+        scaled[i] = scale * base[i];
+    solve_costs(ws, &scaled[0], T, NULL, -1, max_len);
+    if (max_len > 0)
+        drop_forced(ws, &scaled[0], T);
+    for (size_t k = 0; k < found.size(); ++k)
+        if (found[k].changes == ws.changes)
+            return k;
+    PathSegmentation seg;
+    seg.scale = scale;
+    seg.changes = ws.changes;
+    seg.ll = 0;
+    seg.penalty = 0;
+    int start = 0;
+    for (size_t k = 0; k <= seg.changes.size(); ++k) {
+        int end = k < seg.changes.size() ? seg.changes[k] : T;
+        seg.ll += ws.cost.ll(start, end);
+        if (end < T)
+            seg.penalty += base[end - 1];
+        start = end;
+    }
+    found.push_back(seg);
+    return found.size() - 1;
+}
+
+// Changepoints for a range of penalties (CROPS; Haynes, Eckley and
+// Fearnhead, 2017): the optimal segmentations of a row for the penalties
+// base*scale over every scale in [scale_min, scale_max]. Solves at both ends
+// of the range, then at the scale where the optimal segmentations at the ends
+// of a subinterval are equally good, recursing until no new segmentation
+// appears, so each segmentation costs one solve plus one per breakpoint. The
+// row costs are built once for all solves. On return, path holds the
+// segmentations in order of increasing scale, each with the smallest scale in
+// the range at which it is optimal.
+static void solve_path(KernelWorkspace& ws, const RowData& data,
+        const float* base, int T, double scale_min, double scale_max,
+        const npy_int32* ranks, CostModel model, const npy_uint8* bits,
+        int max_len, std::vector<PathSegmentation>& path) {
+    path.clear();
+    if (T < MIN_SEP) {
+        PathSegmentation seg;
+        seg.scale = scale_min;
+        seg.ll = seg.penalty = 0;
+        path.push_back(seg);
+        return;
+    }
+    build_costs(ws, data, T, ranks, model, bits);
+    std::vector<PathSegmentation> found;
+    std::vector<std::pair<size_t, size_t> > pending;
+    pending.push_back(std::make_pair(
+            solve_scaled(ws, base, T, scale_min, max_len, found),
+            solve_scaled(ws, base, T, scale_max, max_len, found)));
+    while (!pending.empty()) {
+        size_t lo = pending.back().first;
+        size_t hi = pending.back().second;
+        pending.pop_back();
+        double dpen = found[lo].penalty - found[hi].penalty;
+        if (lo == hi || dpen <= 0)
+            continue;
+        double scale = (found[lo].ll - found[hi].ll) / dpen;
+        if (!(scale > found[lo].scale && scale < found[hi].scale))
+            continue;
+        size_t before = found.size();
+        size_t mid = solve_scaled(ws, base, T, scale, max_len, found);
+        if (found.size() == before)
+            continue;
+        pending.push_back(std::make_pair(lo, mid));
+        pending.push_back(std::make_pair(mid, hi));
+    }
+    // Keep the lower envelope of the penalized costs -ll + scale*penalty,
+    // in order of decreasing total penalty (increasing scale)
+    std::sort(found.begin(), found.end(), less_penalized);
+    std::reverse(found.begin(), found.end());
+    size_t cur = 0;
+    double best = std::numeric_limits<double>::infinity();
+    for (size_t k = 0; k < found.size(); ++k) {
+        double val = -found[k].ll + scale_min * found[k].penalty;
+        if (val < best) {
+            best = val;
+            cur = k;
+        }
+    }
+    found[cur].scale = scale_min;
+    path.push_back(found[cur]);
+    while (true) {
+        size_t next = cur;
+        double next_scale = scale_max;
+        for (size_t k = cur + 1; k < found.size(); ++k) {
+            double dpen = found[cur].penalty - found[k].penalty;
+            if (dpen <= 0)
+                continue;
+            double scale = (found[cur].ll - found[k].ll) / dpen;
+            if (scale < next_scale || (scale == next_scale && next != cur
+                        && found[k].penalty < found[next].penalty)) {
+                next = k;
+                next_scale = scale;
+            }
+        }
+        if (next == cur)
+            break;
+        cur = next;
+        found[cur].scale = std::max(next_scale, path.back().scale);
+        path.push_back(found[cur]);
+    }
+}
+
+// Log-likelihood differences from moving the change between the segments
+// starting at prev_change and ending at next_change to each time in
+// [start, end], relative to merging the two segments. If reuse is set and
+// the previous call on ws was for the same row and segments, the costs built
+// by that call are used again.
+static void ll_difference_row(KernelWorkspace& ws, const RowData& data,
+        int prev_change, int next_change, int start, int end, double* ll_diff,
+        const npy_int32* ranks = NULL, CostModel model = COST_LAPLACE,
+        const npy_uint8* bits = NULL, bool reuse = false) {
+    SegmentCost& cost = ws.cost;
+    int n = next_change - prev_change;
+    const void* row = bits != NULL ? (const void*) bits : (const void*) data.ptr;
+    if (!reuse || ws.window_row != row || ws.window_prev != prev_change
+            || ws.window_next != next_change) {
+        ws.window_row = NULL;
+        if (bits != NULL)
+            cost.build_bits(bits, prev_change, n);
         else
-            return -n * (1 + log(2 * total_var / n));
+            cost.build(model, data + prev_change, n,
+                    ranks == NULL ? NULL : ranks + prev_change);
+        ws.window_row = row;
+        ws.window_prev = prev_change;
+        ws.window_next = next_change;
+    }
+    double prev_ll = cost.ll(0, n);
+    for (int u = start; u <= end; ++u) {
+        double val = u > prev_change ? cost.ll(0, u - prev_change) : 0;
+        if (prev_ll != -std::numeric_limits<double>::infinity())
+            val += (u < next_change ? cost.ll(u - prev_change, n) : 0) - prev_ll;
+        ll_diff[u - start] = val;
     }
+}
+
+typedef struct {
+    PyObject_HEAD
+    std::vector<KernelWorkspace>* slots;
+    // Last solution of each row for find_changes_batch with resume
+    std::vector<RowState>* states;
+    int threads;
+    int busy;
+} Workspace;
+
+static int resolve_threads(int threads) {
+    if (threads == 0)
+        return std::max(1L, sysconf(_SC_NPROCESSORS_ONLN));
+    return threads;
+}
+
+static void Workspace_dealloc(Workspace* self) {
+    delete self->slots;
+    delete self->states;
+    self->ob_type->tp_free((PyObject*) self);
+}
+
+static int Workspace_init(Workspace* self, PyObject* args, PyObject* kwds) {
+    static const char* kwlist[] = {"T", "threads", NULL};
+    int T;
+    int threads = 1;
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "i|i", (char**) kwlist,
+                &T, &threads)) return -1;
+    if (T < 0 || threads < 0) {
+        PyErr_SetString(PyExc_ValueError, "T and threads must be non-negative");
+        return -1;
+    }
+    if (self->busy) {
+        PyErr_SetString(PyExc_RuntimeError, "Workspace is in use");
+        return -1;
+    }
+    threads = resolve_threads(threads);
+    try {
+        std::vector<KernelWorkspace>* slots = new std::vector<KernelWorkspace>(threads);
+        for (int i = 0; i < threads; ++i)
+            (*slots)[i].reserve(T);
+        delete self->slots;
+        self->slots = slots;
+        delete self->states;
+        self->states = NULL;
+    } catch (std::bad_alloc&) {
+        PyErr_NoMemory();
+        return -1;
+    }
+    self->threads = threads;
+    return 0;
+}
+
+static PyMemberDef Workspace_members[] = {
+    {(char*) "threads", T_INT, offsetof(Workspace, threads), READONLY,
+        (char*) "number of rows that can be solved concurrently"},
+    {NULL}
+};
+
+static PyTypeObject WorkspaceType = {
+    PyObject_HEAD_INIT(NULL)
+    0,                                          /* ob_size */
+    "_univariate_changes.Workspace",            /* tp_name */
+    sizeof(Workspace),                          /* tp_basicsize */
+    0,                                          /* tp_itemsize */
+    (destructor) Workspace_dealloc,             /* tp_dealloc */
+    0,                                          /* tp_print */
+    0,                                          /* tp_getattr */
+    0,                                          /* tp_setattr */
+    0,                                          /* tp_compare */
+    0,                                          /* tp_repr */
+    0,                                          /* tp_as_number */
+    0,                                          /* tp_as_sequence */
+    0,                                          /* tp_as_mapping */
+    0,                                          /* tp_hash */
+    0,                                          /* tp_call */
+    0,                                          /* tp_str */
+    0,                                          /* tp_getattro */
+    0,                                          /* tp_setattro */
+    0,                                          /* tp_as_buffer */
+    Py_TPFLAGS_DEFAULT,                         /* tp_flags */
+    "Workspace(T, threads=1)\n\n"
+    "Kernel buffers for time series of length about T, reused across calls\n"
+    "to find_changes, find_changes_batch and ll_difference. Holds one set\n"
+    "of buffers per thread; threads=0 means one per available core. Also\n"
+    "holds the solver arrays of each row for find_changes_batch with\n"
+    "resume=True, about 24 bytes per frame per row.",
+    0,                                          /* tp_traverse */
+    0,                                          /* tp_clear */
+    0,                                          /* tp_richcompare */
+    0,                                          /* tp_weaklistoffset */
+    0,                                          /* tp_iter */
+    0,                                          /* tp_iternext */
+    0,                                          /* tp_methods */
+    Workspace_members,                          /* tp_members */
+    0,                                          /* tp_getset */
+    0,                                          /* tp_base */
+    0,                                          /* tp_dict */
+    0,                                          /* tp_descr_get */
+    0,                                          /* tp_descr_set */
+    0,                                          /* tp_dictoffset */
+    (initproc) Workspace_init,                  /* tp_init */
+    0,                                          /* tp_alloc */
+    PyType_GenericNew,                          /* tp_new */
+};
+
+// Claims the buffers of a Workspace argument (or None) for one call; a
+// Workspace may only be used by one call at a time.
+static bool acquire_workspace(PyObject* arg, Workspace** ws, int threads) {
+    *ws = NULL;
+    if (arg == Py_None)
+        return true;
+    if (!PyObject_TypeCheck(arg, &WorkspaceType)) {
+        PyErr_SetString(PyExc_TypeError, "workspace must be a Workspace");
+        return false;
+    }
+    Workspace* w = (Workspace*) arg;
+    if (w->slots == NULL || w->threads < threads) {
+        PyErr_SetString(PyExc_ValueError, "Workspace has too few threads");
+        return false;
+    }
+    if (w->busy) {
+        PyErr_SetString(PyExc_RuntimeError, "Workspace is in use");
+        return false;
+    }
+    w->busy = 1;
+    *ws = w;
+    return true;
+}
 
-    std::priority_queue<double, std::vector<double>, std::greater<double> > highs;
-    std::priority_queue<double, std::vector<double>, std::less<double> > lows;
-    int t;
-    int n;
-    double med;
-    double total_var;
-    double cost;
-    int prune_t;
+static void release_workspace(Workspace* ws) {
+    if (ws != NULL)
+        ws->busy = 0;
+}
+
+// Owns a reference to an array argument and releases it on scope exit
+struct ArrayRef {
+    ArrayRef() : obj(NULL) {}
+    ~ArrayRef() { Py_XDECREF(obj); }
+    PyArrayObject* array() const { return (PyArrayObject*) obj; }
+    template <typename V> V* data() const { return (V*) PyArray_DATA(array()); }
+    npy_intp dim(int i) const { return PyArray_DIM(array(), i); }
+    int ndim() const { return PyArray_NDIM(array()); }
+    PyObject* release() { PyObject* o = obj; obj = NULL; return o; }
+    PyObject* obj;
 };
 
-static PyObject* find_changes(PyObject* self, PyObject* args) {
+// Converts an optional argument (None leaves ref.obj NULL) to a C-contiguous
+// array of the given type, whose shape must match `like` if given.
+static bool optional_array(PyObject* arg, int type, ArrayRef& ref,
+        const char* name, const ArrayRef* like = NULL) {
+    if (arg == Py_None)
+        return true;
+    ref.obj = PyArray_FROM_OTF(arg, type, NPY_IN_ARRAY | NPY_FORCECAST);
+    if (ref.obj == NULL)
+        return false;
+    if (like != NULL && !PyArray_SAMESHAPE(ref.array(), like->array())) {
+        PyErr_Format(PyExc_ValueError, "Shape of %s does not match data", name);
+        return false;
+    }
+    return true;
+}
+
+// Converts a data argument to an array. float32 and float64 arrays, and
+// objects exposing such data through the buffer protocol or array interface
+// (e.g. numpy.memmap rows or column views), are read in place with their
+// strides; see data_rows. For the Bernoulli cost, uint8 arrays hold binary
+// values packed along the last axis by numpy.packbits and are made
+// C-contiguous. Anything else is converted to float32.
+static bool data_array(PyObject* arg, CostModel model, ArrayRef& ref,
+        bool* packed) {
+    *packed = PyArray_Check(arg) && PyArray_TYPE(arg) == NPY_UINT8;
+    if (*packed && model != COST_BERNOULLI) {
+        PyErr_SetString(PyExc_ValueError, "Bit-packed (uint8) data require cost='bernoulli'");
+        return false;
+    }
+    if (*packed) {
+        ref.obj = PyArray_FROM_OTF(arg, NPY_UINT8, NPY_IN_ARRAY);
+        return ref.obj != NULL;
+    }
+    ref.obj = PyArray_FROM_OF(arg, NPY_ALIGNED | NPY_NOTSWAPPED);
+    if (ref.obj == NULL)
+        return false;
+    int type = PyArray_TYPE(ref.array());
+    if (type != NPY_FLOAT32 && type != NPY_FLOAT64) {
+        PyObject* converted = PyArray_FROM_OTF(ref.obj, NPY_FLOAT32, NPY_IN_ARRAY);
+        Py_DECREF(ref.obj);
+        ref.obj = converted;
+    }
+    return ref.obj != NULL;
+}
+
+// The rows of an array from data_array
+static DataRows data_rows(const ArrayRef& ref) {
+    DataRows rows;
+    int ndim = ref.ndim();
+    rows.ptr = PyArray_BYTES(ref.array());
+    rows.row_stride = ndim > 1 ? PyArray_STRIDE(ref.array(), 0) : 0;
+    rows.stride = ndim > 0 ? PyArray_STRIDE(ref.array(), ndim - 1) : 0;
+    rows.is_double = PyArray_TYPE(ref.array()) == NPY_FLOAT64;
+    return rows;
+}
+
+static bool check_max_len(int max_len) {
+    if (max_len != 0 && max_len < MIN_SEP) {
+        PyErr_Format(PyExc_ValueError, "max_segment_length must be 0 (unbounded) or at least %d", MIN_SEP);
+        return false;
+    }
+    return true;
+}
+
+// Checks an optional stats output: a writeable C-contiguous float64 array of
+// shape (4,), or (nrows, 4) if nrows >= 0
+static bool check_stats(PyObject* arg, npy_intp nrows) {
+    if (arg == Py_None)
+        return true;
+    if (!PyArray_Check(arg) || PyArray_TYPE(arg) != NPY_FLOAT64
+            || !PyArray_ISCARRAY(arg) || PyArray_NDIM(arg) != (nrows >= 0 ? 2 : 1)
+            || (nrows >= 0 && PyArray_DIM(arg, 0) != nrows)
+            || PyArray_DIM(arg, PyArray_NDIM(arg) - 1) != 4) {
+        PyErr_SetString(PyExc_ValueError, "stats must be a writeable C-contiguous float64 array with 4 columns and one row per solved row");
+        return false;
+    }
+    return true;
+}
+
+// The changes of one row as find_changes returns them: a list, or an int32
+// array including 0 and T (in out if given) if boundaries is set
+static PyObject* changes_object(const std::vector<int>& row_changes, int T,
+        int boundaries, PyObject* arg_out) {
+    if (boundaries || arg_out != Py_None) {
+        npy_intp n = row_changes.size() + 2;
+        PyObject* np_changes;
+        if (arg_out == Py_None) {
+            np_changes = PyArray_SimpleNew(1, &n, NPY_INT32);
+            if (np_changes == NULL) return NULL;
+        } else if (PyArray_DIM(arg_out, 0) < n) {
+            PyErr_SetString(PyExc_ValueError, "Output array is too short; length T+1 always suffices");
+            return NULL;
+        } else {
+            np_changes = PySequence_GetSlice(arg_out, 0, n);
+            if (np_changes == NULL) return NULL;
+        }
+        npy_int32* out = (npy_int32*) PyArray_DATA(np_changes);
+        out[0] = 0;
+        std::copy(row_changes.begin(), row_changes.end(), out + 1);
+        out[n-1] = T;
+        return np_changes;
+    }
+    PyObject* changes = PyList_New(row_changes.size());
+    if (changes == NULL) return NULL;
+    for (size_t i = 0; i < row_changes.size(); ++i)
+        PyList_SET_ITEM(changes, i, PyInt_FromLong(row_changes[i]));
+    return changes;
+}
+
+static PyObject* find_changes(PyObject* self, PyObject* args, PyObject* kwds) {
+    static const char* kwlist[] = {"data", "penalties", "boundaries", "out",
+        "workspace", "ranks", "cost", "candidates", "max_segment_length",
+        "stats", "segments", NULL};
     PyObject* arg1 = NULL;
     PyObject* arg2 = NULL;
-    if (!PyArg_ParseTuple(args, "OO", &arg1, &arg2)) return NULL;
-    PyObject* np_data = PyArray_FROM_OTF(arg1, NPY_FLOAT32, NPY_IN_ARRAY);
-    PyObject* np_penalties = PyArray_FROM_OTF(arg2, NPY_FLOAT32, NPY_IN_ARRAY);
-    if (np_data == NULL || np_penalties == NULL) {
-        Py_XDECREF(np_data);
-        Py_XDECREF(np_penalties);
+    PyObject* arg_out = Py_None;
+    PyObject* arg_ws = Py_None;
+    PyObject* arg_ranks = Py_None;
+    PyObject* arg_cands = Py_None;
+    PyObject* arg_stats = Py_None;
+    const char* cost_name = NULL;
+    int boundaries = 0;
+    int max_len = 0;
+    int segments = 0;
+    CostModel model;
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "OO|iOOOzOiOi", (char**) kwlist,
+                &arg1, &arg2, &boundaries, &arg_out, &arg_ws, &arg_ranks,
+                &cost_name, &arg_cands, &max_len, &arg_stats, &segments))
+        return NULL;
+    if (!parse_cost(cost_name, &model) || !check_max_len(max_len)
+            || !check_stats(arg_stats, -1))
+        return NULL;
+    if (arg_out != Py_None && (!PyArray_Check(arg_out)
+                || PyArray_TYPE(arg_out) != NPY_INT32 || PyArray_NDIM(arg_out) != 1
+                || !PyArray_ISCARRAY(arg_out))) {
+        PyErr_SetString(PyExc_ValueError, "Output must be a writeable 1-dimensional C-contiguous int32 array");
         return NULL;
     }
-    int T = PyArray_DIM(np_data, 0);
-    if (T != PyArray_DIM(np_penalties, 0) + 1) {
+    ArrayRef np_data, np_penalties, np_ranks;
+    bool packed;
+    if (!data_array(arg1, model, np_data, &packed))
+        return NULL;
+    np_penalties.obj = PyArray_FROM_OTF(arg2, NPY_FLOAT32, NPY_IN_ARRAY);
+    if (np_penalties.obj == NULL) return NULL;
+    int T = packed ? np_penalties.dim(0) + 1 : np_data.dim(0);
+    if (T != np_penalties.dim(0) + 1 || (packed && np_data.dim(0) != (T + 7) / 8)) {
         PyErr_SetString(PyExc_ValueError, "Dimensions of data and penalty are not compatible");
-        Py_DECREF(np_data);
-        Py_DECREF(np_penalties);
-        return NULL;
-    }
-    float* data = (float*) PyArray_DATA(np_data);
-    float* penalties = (float*) PyArray_DATA(np_penalties);
-    double* vals = new double[T];
-    int* prev = new int[T];
-    std::list<SuffStat> checks;
-    checks.push_back(SuffStat(0));
-    for (int t = 0; t < MIN_SEP - 1; ++t)
-        checks.back().add(data[t]);
-    for (int t = MIN_SEP - 1; t < T; ++t) {
-        double max_val = -std::numeric_limits<double>::max();
-        int max_ind = -1;
-        for (std::list<SuffStat>::iterator iter = checks.begin(); iter != checks.end(); ++iter) {
-            if (iter->prune_t == t) {
-                iter = checks.erase(iter);
-                --iter;
-                continue;
+        return NULL;
+    }
+    if (!optional_array(arg_ranks, NPY_INT32, np_ranks, "ranks", &np_data))
+        return NULL;
+    ArrayRef np_cands;
+    if (!optional_array(arg_cands, NPY_INT32, np_cands, "candidates"))
+        return NULL;
+    const npy_int32* cands = np_cands.obj ? np_cands.data<npy_int32>() : NULL;
+    int ncands = np_cands.obj ? PyArray_SIZE(np_cands.array()) : -1;
+    if (np_cands.obj && np_cands.ndim() != 1) {
+        PyErr_SetString(PyExc_ValueError, "Candidates must be 1-dimensional");
+        return NULL;
+    }
+    for (int k = 0; k < ncands; ++k) {
+        if (cands[k] < 1 || cands[k] >= T || (k > 0 && cands[k] <= cands[k-1])) {
+            PyErr_SetString(PyExc_ValueError, "Candidates must be increasing times in [1, T-1]");
+            return NULL;
+        }
+    }
+    if (ncands >= 0 && max_len > 0) {
+        for (int k = 0; k <= ncands; ++k) {
+            int gap = (k < ncands ? cands[k] : T) - (k > 0 ? cands[k-1] : 0);
+            if (gap > max_len) {
+                PyErr_SetString(PyExc_ValueError, "Candidates leave a gap longer than max_segment_length");
+                return NULL;
             }
-            iter->add(data[t]);
-            double val = iter->ll();
-            if (iter->t > 0)
-                val += vals[iter->t - 1] - penalties[iter->t - 1];
-            iter->cost = val;
-            if (val > max_val) {
-                max_val = val;
-                max_ind = iter->t;
+        }
+    }
+    Workspace* ws;
+    if (!acquire_workspace(arg_ws, &ws, 1))
+        return NULL;
+    RowData data = packed ? RowData() : data_rows(np_data).row(0);
+    const npy_uint8* bits = packed ? np_data.data<npy_uint8>() : NULL;
+    const float* penalties = np_penalties.data<float>();
+    const npy_int32* ranks = np_ranks.obj ? np_ranks.data<npy_int32>() : NULL;
+    KernelWorkspace local;
+    KernelWorkspace& kws = ws == NULL ? local : (*ws->slots)[0];
+    std::vector<double> fits;
+    bool failed = false;
+    Py_BEGIN_ALLOW_THREADS
+    try {
+        solve_row(kws, data, penalties, T, ranks, model, bits, cands, ncands,
+                max_len);
+        if (segments) {
+            // solve_row builds no costs for rows too short to change
+            if (T < MIN_SEP)
+                build_costs(kws, data, T, ranks, model, bits);
+            std::vector<int> times(1, 0);
+            times.insert(times.end(), kws.changes.begin(), kws.changes.end());
+            times.push_back(T);
+            fits.resize(3 * (times.size() - 1));
+            fit_segments(kws.cost, &times[0], times.size(), &fits[0]);
+        }
+    } catch (std::bad_alloc&) {
+        failed = true;
+    }
+    Py_END_ALLOW_THREADS
+    release_workspace(ws);
+    if (failed)
+        return PyErr_NoMemory();
+    if (arg_stats != Py_None)
+        kws.stats.fill((double*) PyArray_DATA(arg_stats));
+    PyObject* changes = changes_object(kws.changes, T, boundaries, arg_out);
+    if (!segments || changes == NULL)
+        return changes;
+    npy_intp fits_dims[2] = {(npy_intp) fits.size() / 3, 3};
+    PyObject* np_fits = PyArray_SimpleNew(2, fits_dims, NPY_FLOAT64);
+    if (np_fits == NULL) {
+        Py_DECREF(changes);
+        return NULL;
+    }
+    std::copy(fits.begin(), fits.end(), (double*) PyArray_DATA(np_fits));
+    return Py_BuildValue("(NN)", changes, np_fits);
+}
+
+static PyObject* find_changes_path(PyObject* self, PyObject* args, PyObject* kwds) {
+    static const char* kwlist[] = {"data", "base_penalties", "scale_min",
+        "scale_max", "workspace", "ranks", "cost", "max_segment_length", NULL};
+    PyObject* arg1 = NULL;
+    PyObject* arg2 = NULL;
+    PyObject* arg_ws = Py_None;
+    PyObject* arg_ranks = Py_None;
+    const char* cost_name = NULL;
+    double scale_min, scale_max;
+    int max_len = 0;
+    CostModel model;
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "OOdd|OOzi", (char**) kwlist,
+                &arg1, &arg2, &scale_min, &scale_max, &arg_ws, &arg_ranks,
+                &cost_name, &max_len)) return NULL;
+    if (!parse_cost(cost_name, &model) || !check_max_len(max_len))
+        return NULL;
+    if (!(scale_min >= 0 && scale_min <= scale_max)) {
+        PyErr_SetString(PyExc_ValueError, "Scales must satisfy 0 <= scale_min <= scale_max");
+        return NULL;
+    }
+    ArrayRef np_data, np_penalties, np_ranks;
+    bool packed;
+    if (!data_array(arg1, model, np_data, &packed))
+        return NULL;
+    np_penalties.obj = PyArray_FROM_OTF(arg2, NPY_FLOAT32, NPY_IN_ARRAY);
+    if (np_penalties.obj == NULL) return NULL;
+    int T = packed ? np_penalties.dim(0) + 1 : np_data.dim(0);
+    if (T != np_penalties.dim(0) + 1 || (packed && np_data.dim(0) != (T + 7) / 8)) {
+        PyErr_SetString(PyExc_ValueError, "Dimensions of data and penalty are not compatible");
+        return NULL;
+    }
+    if (!optional_array(arg_ranks, NPY_INT32, np_ranks, "ranks", &np_data))
+        return NULL;
+    Workspace* ws;
+    if (!acquire_workspace(arg_ws, &ws, 1))
+        return NULL;
+    RowData data = packed ? RowData() : data_rows(np_data).row(0);
+    const npy_uint8* bits = packed ? np_data.data<npy_uint8>() : NULL;
+    const npy_int32* ranks = np_ranks.obj ? np_ranks.data<npy_int32>() : NULL;
+    const float* base = np_penalties.data<float>();
+    KernelWorkspace local;
+    KernelWorkspace& kws = ws == NULL ? local : (*ws->slots)[0];
+    std::vector<PathSegmentation> path;
+    bool failed = false;
+    Py_BEGIN_ALLOW_THREADS
+    try {
+        solve_path(kws, data, base, T, scale_min, scale_max, ranks, model,
+                bits, max_len, path);
+    } catch (std::bad_alloc&) {
+        failed = true;
+    }
+    Py_END_ALLOW_THREADS
+    release_workspace(ws);
+    if (failed)
+        return PyErr_NoMemory();
+    PyObject* result = PyList_New(path.size());
+    if (result == NULL) return NULL;
+    for (size_t k = 0; k < path.size(); ++k) {
+        PyObject* changes = PyList_New(path[k].changes.size());
+        if (changes == NULL) {
+            Py_DECREF(result);
+            return NULL;
+        }
+        for (size_t i = 0; i < path[k].changes.size(); ++i)
+            PyList_SET_ITEM(changes, i, PyInt_FromLong(path[k].changes[i]));
+        PyObject* item = Py_BuildValue("(dN)", path[k].scale, changes);
+        if (item == NULL) {
+            Py_DECREF(result);
+            return NULL;
+        }
+        PyList_SET_ITEM(result, k, item);
+    }
+    return result;
+}
+
+// Rows of work shared between native threads. Each thread claims the next
+// row with an atomic counter and processes it using its own KernelWorkspace.
+struct RowJob {
+    RowJob(npy_intp _nrows, std::vector<KernelWorkspace>* _slots)
+        : nrows(_nrows), slots(_slots), next_slot(0), next(0), failed(-1) {}
+    virtual ~RowJob() {}
+    virtual void run(KernelWorkspace& ws, npy_intp k) = 0;
+
+    npy_intp nrows;
+    std::vector<KernelWorkspace>* slots;
+    int next_slot;
+    npy_intp next;
+    npy_intp failed;
+};
+
+static void* row_worker(void* arg) {
+    RowJob* job = (RowJob*) arg;
+    KernelWorkspace& ws = (*job->slots)[__sync_fetch_and_add(&job->next_slot, 1)];
+    while (true) {
+        npy_intp k = __sync_fetch_and_add(&job->next, 1);
+        if (k >= job->nrows || job->failed >= 0)
+            break;
+        try {
+            job->run(ws, k);
+        } catch (std::bad_alloc&) {
+            __sync_bool_compare_and_swap(&job->failed, -1, k);
+            break;
+        }
+    }
+    return NULL;
+}
+
+// Runs a job on up to `threads` threads (including the calling one), which
+// must not exceed the number of workspace slots. Call without the GIL.
+static void run_rows(RowJob& job, int threads) {
+    std::vector<pthread_t> workers;
+    for (int i = 1; i < threads; ++i) {
+        pthread_t worker;
+        if (pthread_create(&worker, NULL, row_worker, &job) == 0)
+            workers.push_back(worker);
+    }
+    row_worker(&job);
+    for (size_t i = 0; i < workers.size(); ++i)
+        pthread_join(workers[i], NULL);
+}
+
+// Checks out the KernelWorkspace slots for a threaded call: those of the
+// Workspace argument if given, otherwise freshly allocated local ones.
+static std::vector<KernelWorkspace>* thread_slots(Workspace* ws,
+        std::vector<KernelWorkspace>& local, int threads) {
+    if (ws != NULL)
+        return ws->slots;
+    local.resize(threads);
+    return &local;
+}
+
+struct BatchJob : public RowJob {
+    BatchJob(npy_intp nrows, std::vector<KernelWorkspace>* slots)
+        : RowJob(nrows, slots) {}
+
+    void run(KernelWorkspace& ws, npy_intp k) {
+        npy_intp row = rows[k];
+        RowState* state = states == NULL ? NULL : &(*states)[row];
+        if (bits != NULL)
+            solve_row(ws, RowData(), penalties + row * (T - 1), T, NULL, model,
+                    bits + row * ((T + 7) / 8), NULL, -1, max_len, binseg,
+                    state);
+        else
+            solve_row(ws, data.row(row), penalties + row * (T - 1), T,
+                    ranks == NULL ? NULL : ranks + row * T, model, NULL,
+                    NULL, -1, max_len, binseg, state);
+        (*results)[k] = ws.changes;
+        if (stats != NULL)
+            ws.stats.fill(stats + 4 * k);
+    }
+
+    DataRows data;
+    const npy_uint8* bits;
+    const float* penalties;
+    const npy_int32* ranks;
+    CostModel model;
+    int T;
+    int max_len;
+    bool binseg;
+    const npy_intp* rows;
+    std::vector<std::vector<int> >* results;
+    double* stats;
+    std::vector<RowState>* states;
+};
+
+static PyObject* find_changes_batch(PyObject* self, PyObject* args, PyObject* kwds) {
+    static const char* kwlist[] = {"data", "penalties", "threads", "rows",
+        "boundaries", "workspace", "ranks", "cost", "max_segment_length",
+        "stats", "binseg", "resume", NULL};
+    PyObject* arg1 = NULL;
+    PyObject* arg2 = NULL;
+    PyObject* arg_rows = Py_None;
+    PyObject* arg_ws = Py_None;
+    PyObject* arg_ranks = Py_None;
+    PyObject* arg_stats = Py_None;
+    const char* cost_name = NULL;
+    int threads = 1;
+    int boundaries = 0;
+    int max_len = 0;
+    int binseg = 0;
+    int resume = 0;
+    CostModel model;
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "OO|iOiOOziOii", (char**) kwlist,
+                &arg1, &arg2, &threads, &arg_rows, &boundaries, &arg_ws,
+                &arg_ranks, &cost_name, &max_len, &arg_stats, &binseg, &resume))
+        return NULL;
+    if (resume && arg_ws == Py_None) {
+        PyErr_SetString(PyExc_ValueError, "resume requires a workspace");
+        return NULL;
+    }
+    if (!parse_cost(cost_name, &model) || !check_max_len(max_len))
+        return NULL;
+    threads = resolve_threads(threads);
+    if (threads < 0) {
+        PyErr_SetString(PyExc_ValueError, "Number of threads must be non-negative");
+        return NULL;
+    }
+    ArrayRef np_data, np_penalties, np_rows, np_ranks;
+    bool packed;
+    if (!data_array(arg1, model, np_data, &packed))
+        return NULL;
+    np_penalties.obj = PyArray_FROM_OTF(arg2, NPY_FLOAT32, NPY_IN_ARRAY);
+    if (np_penalties.obj == NULL) return NULL;
+    if (np_data.ndim() != 2 || np_penalties.ndim() != 2
+            || np_data.dim(0) != np_penalties.dim(0)
+            || np_data.dim(1) != (packed ? (np_penalties.dim(1) + 8) / 8
+                : np_penalties.dim(1) + 1)) {
+        PyErr_SetString(PyExc_ValueError, "Dimensions of data and penalty are not compatible");
+        return NULL;
+    }
+    npy_intp J = np_data.dim(0);
+    if (arg_rows == Py_None)
+        np_rows.obj = PyArray_Arange(0, J, 1, NPY_INTP);
+    else
+        np_rows.obj = PyArray_FROM_OTF(arg_rows, NPY_INTP, NPY_IN_ARRAY);
+    if (np_rows.obj == NULL) return NULL;
+    if (np_rows.ndim() != 1) {
+        PyErr_SetString(PyExc_ValueError, "Rows must be 1-dimensional");
+        return NULL;
+    }
+    if (!optional_array(arg_ranks, NPY_INT32, np_ranks, "ranks", &np_data))
+        return NULL;
+    npy_intp nrows = np_rows.dim(0);
+    const npy_intp* rows = np_rows.data<npy_intp>();
+    for (npy_intp k = 0; k < nrows; ++k) {
+        if (rows[k] < 0 || rows[k] >= J) {
+            PyErr_SetString(PyExc_IndexError, "Row index out of range");
+            return NULL;
+        }
+    }
+    if (!check_stats(arg_stats, nrows))
+        return NULL;
+    if (resume) {
+        // Each row's saved solution may only be resumed by one thread
+        std::vector<bool> seen(J);
+        for (npy_intp k = 0; k < nrows; ++k) {
+            if (seen[rows[k]]) {
+                PyErr_SetString(PyExc_ValueError, "Rows must be distinct to resume");
+                return NULL;
             }
+            seen[rows[k]] = true;
         }
-        vals[t] = max_val;
-        prev[t] = max_ind;
-        for (std::list<SuffStat>::iterator iter = checks.begin(); iter != checks.end(); ++iter) {
-            if (t < T-1 && iter->prune_t == -1 && iter->cost < vals[t] - penalties[t])
-                iter->prune_t = t + MIN_SEP;
+    }
+    if (threads > nrows)
+        threads = std::max(nrows, (npy_intp) 1);
+    Workspace* ws;
+    if (!acquire_workspace(arg_ws, &ws, threads))
+        return NULL;
+    std::vector<std::vector<int> > results;
+    std::vector<KernelWorkspace> local;
+    std::vector<KernelWorkspace>* slots;
+    try {
+        results.resize(nrows);
+        slots = thread_slots(ws, local, threads);
+        if (resume) {
+            if (ws->states == NULL)
+                ws->states = new std::vector<RowState>();
+            if (ws->states->size() < (size_t) J)
+                ws->states->resize(J);
         }
-        if (t - MIN_SEP + 2 >= MIN_SEP) {
-            checks.push_back(SuffStat(t-MIN_SEP+2));
-            for (int s = t - MIN_SEP + 2; s <= t; ++s)
-                checks.back().add(data[s]);
+    } catch (std::bad_alloc&) {
+        release_workspace(ws);
+        return PyErr_NoMemory();
+    }
+    BatchJob job(nrows, slots);
+    job.data = data_rows(np_data);
+    job.bits = packed ? np_data.data<npy_uint8>() : NULL;
+    job.penalties = np_penalties.data<float>();
+    job.ranks = np_ranks.obj ? np_ranks.data<npy_int32>() : NULL;
+    job.model = model;
+    job.T = np_penalties.dim(1) + 1;
+    job.max_len = max_len;
+    job.binseg = binseg;
+    job.rows = rows;
+    job.results = &results;
+    job.stats = arg_stats == Py_None ? NULL : (double*) PyArray_DATA(arg_stats);
+    job.states = resume ? ws->states : NULL;
+    Py_BEGIN_ALLOW_THREADS
+    run_rows(job, threads);
+    Py_END_ALLOW_THREADS
+    release_workspace(ws);
+    if (job.failed >= 0) {
+        PyErr_Format(PyExc_MemoryError, "Out of memory in row %ld", (long) rows[job.failed]);
+        return NULL;
+    }
+    npy_intp offsets_dims[1] = {nrows + 1};
+    ArrayRef np_offsets, np_times;
+    np_offsets.obj = PyArray_SimpleNew(1, offsets_dims, NPY_INTP);
+    if (np_offsets.obj == NULL) return NULL;
+    npy_intp* offsets = np_offsets.data<npy_intp>();
+    int extra = boundaries ? 2 : 0;
+    offsets[0] = 0;
+    for (npy_intp k = 0; k < nrows; ++k)
+        offsets[k+1] = offsets[k] + results[k].size() + extra;
+    npy_intp times_dims[1] = {offsets[nrows]};
+    np_times.obj = PyArray_SimpleNew(1, times_dims, NPY_INT32);
+    if (np_times.obj == NULL) return NULL;
+    npy_int32* times = np_times.data<npy_int32>();
+    for (npy_intp k = 0; k < nrows; ++k) {
+        npy_int32* out = times + offsets[k];
+        if (boundaries) {
+            *(out++) = 0;
+            times[offsets[k+1] - 1] = job.T;
         }
+        std::copy(results[k].begin(), results[k].end(), out);
     }
-    PyObject* changes = PyList_New(0);
-    int ind = prev[T-1];
-    while (ind > 1) {
-        PyObject* num = PyInt_FromLong(ind);
-        PyList_Append(changes, num);
-        Py_DECREF(num);
-        ind = prev[ind-1];
+    return Py_BuildValue("(NN)", np_offsets.release(), np_times.release());
+}
+
+struct RanksJob : public RowJob {
+    RanksJob(npy_intp nrows, std::vector<KernelWorkspace>* slots)
+        : RowJob(nrows, slots) {}
+
+    void run(KernelWorkspace& ws, npy_intp k) {
+        RowData row = data.row(k);
+        npy_int32* row_ranks = ranks + k * T;
+        std::vector<int>& order = ws.cost.index.order;
+        order.resize(T);
+        for (int i = 0; i < T; ++i)
+            order[i] = i;
+        std::sort(order.begin(), order.end(), RankLess(row));
+        for (int r = 0; r < T; ++r)
+            row_ranks[order[r]] = r;
     }
-    PyList_Reverse(changes);
-    delete[] vals;
-    delete[] prev;
-    Py_DECREF(np_data);
-    Py_DECREF(np_penalties);
-    return changes;
+
+    DataRows data;
+    npy_int32* ranks;
+    int T;
+};
+
+static PyObject* compute_ranks(PyObject* self, PyObject* args, PyObject* kwds) {
+    static const char* kwlist[] = {"data", "threads", "workspace", NULL};
+    PyObject* arg1 = NULL;
+    PyObject* arg_ws = Py_None;
+    int threads = 1;
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O|iO", (char**) kwlist,
+                &arg1, &threads, &arg_ws)) return NULL;
+    threads = resolve_threads(threads);
+    if (threads < 0) {
+        PyErr_SetString(PyExc_ValueError, "Number of threads must be non-negative");
+        return NULL;
+    }
+    ArrayRef np_data, np_ranks;
+    bool packed;
+    if (!data_array(arg1, COST_LAPLACE, np_data, &packed))
+        return NULL;
+    if (np_data.ndim() != 1 && np_data.ndim() != 2) {
+        PyErr_SetString(PyExc_ValueError, "Data must be 1- or 2-dimensional");
+        return NULL;
+    }
+    np_ranks.obj = PyArray_SimpleNew(np_data.ndim(), PyArray_DIMS(np_data.array()), NPY_INT32);
+    if (np_ranks.obj == NULL) return NULL;
+    npy_intp nrows = np_data.ndim() == 2 ? np_data.dim(0) : 1;
+    if (threads > nrows)
+        threads = std::max(nrows, (npy_intp) 1);
+    Workspace* ws;
+    if (!acquire_workspace(arg_ws, &ws, threads))
+        return NULL;
+    std::vector<KernelWorkspace> local;
+    std::vector<KernelWorkspace>* slots;
+    try {
+        slots = thread_slots(ws, local, threads);
+    } catch (std::bad_alloc&) {
+        release_workspace(ws);
+        return PyErr_NoMemory();
+    }
+    RanksJob job(nrows, slots);
+    job.data = data_rows(np_data);
+    job.ranks = np_ranks.data<npy_int32>();
+    job.T = np_data.dim(np_data.ndim() - 1);
+    Py_BEGIN_ALLOW_THREADS
+    run_rows(job, threads);
+    Py_END_ALLOW_THREADS
+    release_workspace(ws);
+    if (job.failed >= 0)
+        return PyErr_NoMemory();
+    return np_ranks.release();
 }
 
-static PyObject* ll_difference(PyObject* self, PyObject* args) {
+static PyObject* ll_difference(PyObject* self, PyObject* args, PyObject* kwds) {
+    static const char* kwlist[] = {"data", "prev_change", "next_change",
+        "start", "end", "workspace", "ranks", "cost", NULL};
     PyObject* arg1 = NULL;
+    PyObject* arg_ws = Py_None;
+    PyObject* arg_ranks = Py_None;
+    const char* cost_name = NULL;
     int prev_change, next_change, start, end;
-    if (!PyArg_ParseTuple(args, "Oiiii", &arg1, &prev_change,
-                &next_change, &start, &end)) return NULL;
-    PyObject* np_data = PyArray_FROM_OTF(arg1, NPY_FLOAT32, NPY_IN_ARRAY);
-    if (np_data == NULL) return NULL;
-    int T = PyArray_DIM(np_data, 0);
-    if (start < 0 || start >= end || T < end) {
+    CostModel model;
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "Oiiii|OOz", (char**) kwlist,
+                &arg1, &prev_change, &next_change, &start, &end, &arg_ws,
+                &arg_ranks, &cost_name)) return NULL;
+    if (!parse_cost(cost_name, &model))
+        return NULL;
+    ArrayRef np_data, np_ranks, np_ll_diff;
+    bool packed;
+    if (!data_array(arg1, model, np_data, &packed))
+        return NULL;
+    // Packed data only bound T to the next multiple of 8
+    int T = packed ? 8 * np_data.dim(0) : np_data.dim(0);
+    if (start < 0 || start >= end || T < end || prev_change < 0
+            || prev_change > start || next_change < end || next_change > T) {
         PyErr_SetString(PyExc_ValueError, "Dimensions of data are not compatible with start and end values");
-        Py_DECREF(np_data);
         return NULL;
     }
-    float* data = (float*) PyArray_DATA(np_data);
+    if (!optional_array(arg_ranks, NPY_INT32, np_ranks, "ranks", &np_data))
+        return NULL;
     npy_intp out_dims[1];
     *out_dims = end - start + 1;
-    PyObject* np_ll_diff = PyArray_SimpleNew(1, out_dims, NPY_FLOAT64);
-    double* ll_diff = (double*) PyArray_DATA(np_ll_diff);
-    if (prev_change == start)
-        ll_diff[0] = 0;
-    SuffStat tmp(0);
-    for (int t = prev_change; t < next_change; ++t) {
-        tmp.add(data[t]);
-        if (t >= start-1 && t < end)
-            ll_diff[t-start+1] = tmp.ll();
-    }
-    double prev_ll = tmp.ll();
-    if (prev_ll == -std::numeric_limits<double>::infinity()) {
-        Py_DECREF(np_data);
-        return np_ll_diff;
-    }
-    if (next_change == end)
-        ll_diff[end - start] -= prev_ll;
-    tmp = SuffStat(0);
-    for (int t = next_change - 1; t >= start; --t) {
-        tmp.add(data[t]);
-        if (t <= end)
-            ll_diff[t-start] += tmp.ll() - prev_ll;
-    }
-    Py_DECREF(np_data);
-    return np_ll_diff;
+    np_ll_diff.obj = PyArray_SimpleNew(1, out_dims, NPY_FLOAT64);
+    if (np_ll_diff.obj == NULL) return NULL;
+    Workspace* ws;
+    if (!acquire_workspace(arg_ws, &ws, 1))
+        return NULL;
+    RowData data = packed ? RowData() : data_rows(np_data).row(0);
+    const npy_uint8* bits = packed ? np_data.data<npy_uint8>() : NULL;
+    const npy_int32* ranks = np_ranks.obj ? np_ranks.data<npy_int32>() : NULL;
+    double* ll_diff = np_ll_diff.data<double>();
+    KernelWorkspace local;
+    KernelWorkspace& kws = ws == NULL ? local : (*ws->slots)[0];
+    bool failed = false;
+    Py_BEGIN_ALLOW_THREADS
+    try {
+        ll_difference_row(kws, data, prev_change, next_change, start, end,
+                ll_diff, ranks, model, bits);
+    } catch (std::bad_alloc&) {
+        failed = true;
+    }
+    Py_END_ALLOW_THREADS
+    release_workspace(ws);
+    if (failed)
+        return PyErr_NoMemory();
+    return np_ll_diff.release();
+}
+
+struct DifferencesJob : public RowJob {
+    DifferencesJob(npy_intp nwindows, std::vector<KernelWorkspace>* slots)
+        : RowJob(nwindows, slots) {}
+
+    void run(KernelWorkspace& ws, npy_intp k) {
+        npy_intp row = rows == NULL ? 0 : rows[k];
+        ll_difference_row(ws, data.row(row), prevs[k], nexts[k], starts[k], ends[k], out + offsets[k],
+                ranks == NULL ? NULL : ranks + row * T, model,
+                bits == NULL ? NULL : bits + row * row_bytes, true);
+    }
+
+    DataRows data;
+    const npy_uint8* bits;
+    const npy_int32* ranks;
+    CostModel model;
+    npy_intp T;
+    npy_intp row_bytes;
+    const npy_intp* rows;
+    const npy_int32* prevs;
+    const npy_int32* nexts;
+    const npy_int32* starts;
+    const npy_int32* ends;
+    const npy_intp* offsets;
+    double* out;
+};
+
+static PyObject* ll_differences(PyObject* self, PyObject* args, PyObject* kwds) {
+    static const char* kwlist[] = {"data", "rows", "prev_changes",
+        "next_changes", "starts", "ends", "out", "threads", "workspace",
+        "ranks", "cost", NULL};
+    PyObject* arg1 = NULL;
+    PyObject* arg_rows = NULL;
+    PyObject* arg_prevs = NULL;
+    PyObject* arg_nexts = NULL;
+    PyObject* arg_starts = NULL;
+    PyObject* arg_ends = NULL;
+    PyObject* arg_out = Py_None;
+    PyObject* arg_ws = Py_None;
+    PyObject* arg_ranks = Py_None;
+    const char* cost_name = NULL;
+    int threads = 1;
+    CostModel model;
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "OOOOOO|OiOOz", (char**) kwlist,
+                &arg1, &arg_rows, &arg_prevs, &arg_nexts, &arg_starts,
+                &arg_ends, &arg_out, &threads, &arg_ws, &arg_ranks, &cost_name))
+        return NULL;
+    if (!parse_cost(cost_name, &model))
+        return NULL;
+    threads = resolve_threads(threads);
+    if (threads < 0) {
+        PyErr_SetString(PyExc_ValueError, "Number of threads must be non-negative");
+        return NULL;
+    }
+    ArrayRef np_data, np_ranks, np_rows, np_prevs, np_nexts, np_starts, np_ends;
+    bool packed;
+    if (!data_array(arg1, model, np_data, &packed))
+        return NULL;
+    if (np_data.ndim() != 1 && np_data.ndim() != 2) {
+        PyErr_SetString(PyExc_ValueError, "Data must be 1- or 2-dimensional");
+        return NULL;
+    }
+    if (!optional_array(arg_ranks, NPY_INT32, np_ranks, "ranks", &np_data))
+        return NULL;
+    npy_intp J = np_data.ndim() == 2 ? np_data.dim(0) : 1;
+    npy_intp width = np_data.dim(np_data.ndim() - 1);
+    // Packed data only bound T to the next multiple of 8
+    npy_intp T = packed ? 8 * width : width;
+    if (!optional_array(arg_rows, NPY_INTP, np_rows, "rows")
+            || !optional_array(arg_prevs, NPY_INT32, np_prevs, "prev_changes")
+            || !optional_array(arg_nexts, NPY_INT32, np_nexts, "next_changes", &np_prevs)
+            || !optional_array(arg_starts, NPY_INT32, np_starts, "starts", &np_prevs)
+            || !optional_array(arg_ends, NPY_INT32, np_ends, "ends", &np_prevs))
+        return NULL;
+    if (np_prevs.obj == NULL || np_nexts.obj == NULL || np_starts.obj == NULL
+            || np_ends.obj == NULL || np_prevs.ndim() != 1) {
+        PyErr_SetString(PyExc_ValueError, "Windows must be given as 1-dimensional arrays");
+        return NULL;
+    }
+    npy_intp nwindows = np_prevs.dim(0);
+    if (np_rows.obj == NULL ? np_data.ndim() != 1
+            : np_rows.ndim() != 1 || np_rows.dim(0) != nwindows) {
+        PyErr_SetString(PyExc_ValueError, "Rows must give one row of 2-dimensional data per window, or be None for 1-dimensional data");
+        return NULL;
+    }
+    const npy_intp* rows = np_rows.obj ? np_rows.data<npy_intp>() : NULL;
+    const npy_int32* prevs = np_prevs.data<npy_int32>();
+    const npy_int32* nexts = np_nexts.data<npy_int32>();
+    const npy_int32* starts = np_starts.data<npy_int32>();
+    const npy_int32* ends = np_ends.data<npy_int32>();
+    std::vector<npy_intp> offsets(nwindows + 1);
+    offsets[0] = 0;
+    for (npy_intp k = 0; k < nwindows; ++k) {
+        if (rows != NULL && (rows[k] < 0 || rows[k] >= J)) {
+            PyErr_SetString(PyExc_IndexError, "Row index out of range");
+            return NULL;
+        }
+        if (starts[k] < 0 || starts[k] >= ends[k] || T < ends[k]
+                || prevs[k] < 0 || prevs[k] > starts[k] || nexts[k] < ends[k]
+                || nexts[k] > T) {
+            PyErr_Format(PyExc_ValueError, "Dimensions of data are not compatible with start and end values of window %ld", (long) k);
+            return NULL;
+        }
+        offsets[k+1] = offsets[k] + ends[k] - starts[k] + 1;
+    }
+    ArrayRef np_out;
+    if (arg_out == Py_None) {
+        npy_intp out_dims[1] = {offsets[nwindows]};
+        np_out.obj = PyArray_SimpleNew(1, out_dims, NPY_FLOAT64);
+        if (np_out.obj == NULL) return NULL;
+    } else if (!PyArray_Check(arg_out) || PyArray_TYPE(arg_out) != NPY_FLOAT64
+            || PyArray_NDIM(arg_out) != 1 || !PyArray_ISCARRAY(arg_out)
+            || PyArray_DIM(arg_out, 0) < offsets[nwindows]) {
+        PyErr_SetString(PyExc_ValueError, "Output must be a writeable 1-dimensional C-contiguous float64 array with room for every window");
+        return NULL;
+    } else {
+        np_out.obj = PySequence_GetSlice(arg_out, 0, offsets[nwindows]);
+        if (np_out.obj == NULL) return NULL;
+    }
+    if (threads > nwindows)
+        threads = std::max(nwindows, (npy_intp) 1);
+    Workspace* ws;
+    if (!acquire_workspace(arg_ws, &ws, threads))
+        return NULL;
+    std::vector<KernelWorkspace> local;
+    std::vector<KernelWorkspace>* slots;
+    try {
+        slots = thread_slots(ws, local, threads);
+    } catch (std::bad_alloc&) {
+        release_workspace(ws);
+        return PyErr_NoMemory();
+    }
+    for (size_t i = 0; i < slots->size(); ++i)
+        (*slots)[i].window_row = NULL;
+    DifferencesJob job(nwindows, slots);
+    job.data = data_rows(np_data);
+    job.bits = packed ? np_data.data<npy_uint8>() : NULL;
+    job.ranks = np_ranks.obj ? np_ranks.data<npy_int32>() : NULL;
+    job.model = model;
+    job.T = width;
+    job.row_bytes = width;
+    job.rows = rows;
+    job.prevs = prevs;
+    job.nexts = nexts;
+    job.starts = starts;
+    job.ends = ends;
+    job.offsets = &offsets[0];
+    job.out = np_out.data<double>();
+    Py_BEGIN_ALLOW_THREADS
+    run_rows(job, threads);
+    Py_END_ALLOW_THREADS
+    release_workspace(ws);
+    if (job.failed >= 0)
+        return PyErr_NoMemory();
+    return np_out.release();
+}
+
+// Penalties p(S) = lam*(sum_{G in groups} |S intersect G|^beta)^alpha of
+// sets of rows S, given the groups of each row in CSR form. Terms are summed
+// in order of increasing group index, skipping empty intersections.
+struct GroupPenalty {
+    GroupPenalty(double _lam, double _alpha, double _beta, npy_intp J,
+            const npy_intp* _indptr, const npy_int32* _indices, int ngroups)
+        : lam(_lam), alpha(_alpha), beta(_beta), indptr(_indptr),
+          indices(_indices), counts(ngroups, 0), marks(J, 0), mark(0) {}
+
+    // p(a | b), or p(a) if b is NULL; a and b hold distinct rows each
+    double operator()(const std::vector<int>& a, const std::vector<int>* b = NULL) {
+        ++mark;
+        touched.clear();
+        add(a);
+        if (b != NULL)
+            add(*b);
+        std::sort(touched.begin(), touched.end());
+        double total = 0;
+        for (size_t k = 0; k < touched.size(); ++k) {
+            total += pow((double) counts[touched[k]], beta);
+            counts[touched[k]] = 0;
+        }
+        return lam * pow(total, alpha);
+    }
+
+    void add(const std::vector<int>& rows) {
+        for (size_t k = 0; k < rows.size(); ++k) {
+            int row = rows[k];
+            if (marks[row] == mark)
+                continue;
+            marks[row] = mark;
+            for (npy_intp j = indptr[row]; j < indptr[row+1]; ++j)
+                if (counts[indices[j]]++ == 0)
+                    touched.push_back(indices[j]);
+        }
+    }
+
+    double lam;
+    double alpha;
+    double beta;
+    const npy_intp* indptr;
+    const npy_int32* indices;
+    std::vector<int> counts;
+    std::vector<int> marks;
+    int mark;
+    std::vector<int> touched;
+};
+
+// Sorted union of two sorted sets of rows
+static void merge_rows(std::vector<int>& into, const std::vector<int>& from) {
+    std::vector<int> merged(into.size() + from.size());
+    merged.erase(std::set_union(into.begin(), into.end(), from.begin(),
+                from.end(), merged.begin()), merged.end());
+    into.swap(merged);
+}
+
+// Shift/merge stage of ComputeChanges for the rows of one process. Each
+// change time (between those before and after it) is moved to the time that
+// maximizes the total log-likelihood of the rows changing there, less the
+// change penalties, or merged into a neighbouring change time. row_changes
+// holds the changes of each row including 0 and T, and is updated in place.
+static void shift_and_merge_rows(KernelWorkspace& ws, const DataRows& data,
+        const npy_uint8* bits, npy_intp width, const npy_int32* ranks,
+        CostModel model, std::vector<std::vector<int> >& row_changes,
+        GroupPenalty& penalty) {
+    npy_intp J = row_changes.size();
+    std::vector<int> change_times;
+    std::vector<std::vector<int> > changed;
+    {
+        std::vector<std::pair<int, int> > pairs;
+        for (npy_intp i = 0; i < J; ++i)
+            for (size_t k = 0; k < row_changes[i].size(); ++k)
+                pairs.push_back(std::make_pair(row_changes[i][k], (int) i));
+        std::sort(pairs.begin(), pairs.end());
+        for (size_t k = 0; k < pairs.size(); ++k) {
+            if (change_times.empty() || change_times.back() != pairs[k].first) {
+                change_times.push_back(pairs[k].first);
+                changed.push_back(std::vector<int>());
+            }
+            changed.back().push_back(pairs[k].second);
+        }
+    }
+    // Rows only need their position among their changes when they change at
+    // the middle time, so positions are advanced lazily
+    std::vector<int> prev_ind(J, 0);
+    std::vector<int> next_ind(J, 0);
+    std::vector<double> total;
+    std::vector<double> row_diff;
+    ws.window_row = NULL;
+    for (int t = 0; t < (int) change_times.size() - 2; ++t) {
+        int start = change_times[t];
+        int end = change_times[t+2];
+        total.assign(end - start + 1, 0.0);
+        row_diff.resize(end - start + 1);
+        const std::vector<int>& rows = changed[t+1];
+        for (size_t k = 0; k < rows.size(); ++k) {
+            int i = rows[k];
+            const std::vector<int>& c = row_changes[i];
+            while (c[prev_ind[i]+1] <= start)
+                ++prev_ind[i];
+            if (next_ind[i] < prev_ind[i])
+                next_ind[i] = prev_ind[i];
+            while (c[next_ind[i]] < end)
+                ++next_ind[i];
+            ll_difference_row(ws, data.row(i),
+                    c[prev_ind[i]], c[next_ind[i]], start, end, &row_diff[0],
+                    ranks == NULL ? NULL : ranks + i * width, model,
+                    bits == NULL ? NULL : bits + i * width, true);
+            for (size_t u = 0; u < total.size(); ++u)
+                total[u] += row_diff[u];
+        }
+        total[0] -= penalty(changed[t], &changed[t+1]) - penalty(changed[t])
+            - penalty(changed[t+1]);
+        total.back() -= penalty(changed[t+2], &changed[t+1])
+            - penalty(changed[t+2]) - penalty(changed[t+1]);
+        size_t best = 0;
+        for (size_t u = 1; u < total.size(); ++u)
+            if (total[u] > total[best])
+                best = u;
+        int max_t = start + best;
+        if (max_t == change_times[t+1])
+            continue;
+        if (max_t == start || max_t == end) {
+            std::vector<int>& into = changed[max_t == start ? t : t+2];
+            for (size_t k = 0; k < rows.size(); ++k) {
+                int i = rows[k];
+                std::vector<int>& c = row_changes[i];
+                if (std::binary_search(into.begin(), into.end(), i)) {
+                    c.erase(c.begin() + prev_ind[i] + 1);
+                    --next_ind[i];
+                } else
+                    c[prev_ind[i]+1] = max_t;
+            }
+            merge_rows(into, rows);
+            changed.erase(changed.begin() + t + 1);
+            change_times.erase(change_times.begin() + t + 1);
+            --t;
+        } else {
+            change_times[t+1] = max_t;
+            for (size_t k = 0; k < rows.size(); ++k) {
+                int i = rows[k];
+                row_changes[i][prev_ind[i]+1] = max_t;
+            }
+        }
+    }
+}
+
+static PyObject* shift_and_merge(PyObject* self, PyObject* args, PyObject* kwds) {
+    static const char* kwlist[] = {"data", "offsets", "times", "group_indptr",
+        "group_indices", "lam", "alpha", "beta", "workspace", "ranks", "cost",
+        NULL};
+    PyObject* arg1 = NULL;
+    PyObject* arg_offsets = NULL;
+    PyObject* arg_times = NULL;
+    PyObject* arg_indptr = NULL;
+    PyObject* arg_indices = NULL;
+    PyObject* arg_ws = Py_None;
+    PyObject* arg_ranks = Py_None;
+    const char* cost_name = NULL;
+    double lam, alpha, beta;
+    CostModel model;
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "OOOOOddd|OOz", (char**) kwlist,
+                &arg1, &arg_offsets, &arg_times, &arg_indptr, &arg_indices,
+                &lam, &alpha, &beta, &arg_ws, &arg_ranks, &cost_name))
+        return NULL;
+    if (!parse_cost(cost_name, &model))
+        return NULL;
+    ArrayRef np_data, np_ranks, np_offsets, np_times, np_indptr, np_indices;
+    bool packed;
+    if (!data_array(arg1, model, np_data, &packed))
+        return NULL;
+    if (np_data.ndim() != 2) {
+        PyErr_SetString(PyExc_ValueError, "Data must be 2-dimensional");
+        return NULL;
+    }
+    if (!optional_array(arg_ranks, NPY_INT32, np_ranks, "ranks", &np_data)
+            || !optional_array(arg_offsets, NPY_INTP, np_offsets, "offsets")
+            || !optional_array(arg_times, NPY_INT32, np_times, "times")
+            || !optional_array(arg_indptr, NPY_INTP, np_indptr, "group_indptr")
+            || !optional_array(arg_indices, NPY_INT32, np_indices, "group_indices"))
+        return NULL;
+    npy_intp J = np_data.dim(0);
+    npy_intp width = np_data.dim(1);
+    if (np_offsets.obj == NULL || np_times.obj == NULL || np_indptr.obj == NULL
+            || np_indices.obj == NULL || np_offsets.ndim() != 1
+            || np_offsets.dim(0) != J + 1 || np_indptr.ndim() != 1
+            || np_indptr.dim(0) != J + 1 || np_times.ndim() != 1
+            || np_indices.ndim() != 1) {
+        PyErr_SetString(PyExc_ValueError, "Changes and groups must be given in CSR form with one row per row of data");
+        return NULL;
+    }
+    const npy_intp* offsets = np_offsets.data<npy_intp>();
+    const npy_int32* times = np_times.data<npy_int32>();
+    const npy_intp* indptr = np_indptr.data<npy_intp>();
+    const npy_int32* indices = np_indices.data<npy_int32>();
+    // All rows must have the same length T, and changes at 0 and T
+    int T = -1;
+    std::vector<std::vector<int> > row_changes;
+    int ngroups = 0;
+    try {
+        row_changes.resize(J);
+        for (npy_intp i = 0; i < J; ++i) {
+            npy_intp lo = offsets[i], hi = offsets[i+1];
+            bool valid = 0 <= lo && lo + 2 <= hi && hi <= np_times.dim(0)
+                && times[lo] == 0 && (T < 0 || times[hi-1] == T)
+                && indptr[i] >= 0 && indptr[i] <= indptr[i+1]
+                && indptr[i+1] <= np_indices.dim(0);
+            for (npy_intp k = lo + 1; valid && k < hi; ++k)
+                valid = times[k] > times[k-1];
+            if (!valid) {
+                PyErr_Format(PyExc_ValueError, "Invalid changes or groups for row %ld", (long) i);
+                return NULL;
+            }
+            T = times[hi-1];
+            row_changes[i].assign(times + lo, times + hi);
+            for (npy_intp j = indptr[i]; j < indptr[i+1]; ++j) {
+                if (indices[j] < 0) {
+                    PyErr_SetString(PyExc_ValueError, "Negative group index");
+                    return NULL;
+                }
+                ngroups = std::max(ngroups, indices[j] + 1);
+            }
+        }
+    } catch (std::bad_alloc&) {
+        return PyErr_NoMemory();
+    }
+    if (J > 0 && (packed ? (T + 7) / 8 != width : T != width)) {
+        PyErr_SetString(PyExc_ValueError, "Changes do not end at the length of the data");
+        return NULL;
+    }
+    Workspace* ws;
+    if (!acquire_workspace(arg_ws, &ws, 1))
+        return NULL;
+    KernelWorkspace local;
+    KernelWorkspace& kws = ws == NULL ? local : (*ws->slots)[0];
+    bool failed = false;
+    Py_BEGIN_ALLOW_THREADS
+    try {
+        GroupPenalty penalty(lam, alpha, beta, J, indptr, indices, ngroups);
+        shift_and_merge_rows(kws, data_rows(np_data),
+                packed ? np_data.data<npy_uint8>() : NULL, width,
+                np_ranks.obj ? np_ranks.data<npy_int32>() : NULL, model,
+                row_changes, penalty);
+    } catch (std::bad_alloc&) {
+        failed = true;
+    }
+    Py_END_ALLOW_THREADS
+    release_workspace(ws);
+    if (failed)
+        return PyErr_NoMemory();
+    npy_intp offsets_dims[1] = {J + 1};
+    ArrayRef np_new_offsets, np_new_times;
+    np_new_offsets.obj = PyArray_SimpleNew(1, offsets_dims, NPY_INTP);
+    if (np_new_offsets.obj == NULL) return NULL;
+    npy_intp* new_offsets = np_new_offsets.data<npy_intp>();
+    new_offsets[0] = 0;
+    for (npy_intp i = 0; i < J; ++i)
+        new_offsets[i+1] = new_offsets[i] + row_changes[i].size();
+    npy_intp times_dims[1] = {new_offsets[J]};
+    np_new_times.obj = PyArray_SimpleNew(1, times_dims, NPY_INT32);
+    if (np_new_times.obj == NULL) return NULL;
+    npy_int32* new_times = np_new_times.data<npy_int32>();
+    for (npy_intp i = 0; i < J; ++i)
+        std::copy(row_changes[i].begin(), row_changes[i].end(),
+                new_times + new_offsets[i]);
+    return Py_BuildValue("(NN)", np_new_offsets.release(), np_new_times.release());
+}
+
+// 64-bit FNV-1a hash of n bytes
+static npy_uint64 fnv1a(const unsigned char* bytes, npy_intp n) {
+    npy_uint64 hash = 14695981039346656037ULL;
+    for (npy_intp i = 0; i < n; ++i) {
+        hash ^= bytes[i];
+        hash *= 1099511628211ULL;
+    }
+    return hash;
+}
+
+static PyObject* fingerprints(PyObject* self, PyObject* args, PyObject* kwds) {
+    static const char* kwlist[] = {"penalties", NULL};
+    PyObject* arg1 = NULL;
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O", (char**) kwlist, &arg1))
+        return NULL;
+    ArrayRef np_penalties, np_out;
+    np_penalties.obj = PyArray_FROM_OTF(arg1, NPY_FLOAT32, NPY_IN_ARRAY);
+    if (np_penalties.obj == NULL) return NULL;
+    if (np_penalties.ndim() != 2) {
+        PyErr_SetString(PyExc_ValueError, "Penalties must be 2-dimensional");
+        return NULL;
+    }
+    npy_intp J = np_penalties.dim(0);
+    npy_intp row_bytes = np_penalties.dim(1) * sizeof(float);
+    np_out.obj = PyArray_SimpleNew(1, &J, NPY_UINT64);
+    if (np_out.obj == NULL) return NULL;
+    const unsigned char* bytes = np_penalties.data<unsigned char>();
+    npy_uint64* out = np_out.data<npy_uint64>();
+    Py_BEGIN_ALLOW_THREADS
+    for (npy_intp i = 0; i < J; ++i)
+        out[i] = fnv1a(bytes + i * row_bytes, row_bytes);
+    Py_END_ALLOW_THREADS
+    return np_out.release();
+}
+
+// Philox4x32-10 counter-based generator (Salmon et al., "Parallel random
+// numbers: as easy as 1, 2, 3", SC 2011): replaces the counter ctr by four
+// random words determined by ctr and the key (key0, key1)
+static void philox4x32(npy_uint32 ctr[4], npy_uint32 key0, npy_uint32 key1) {
+    for (int round = 0; round < 10; ++round) {
+        npy_uint64 prod0 = (npy_uint64) 0xD2511F53u * ctr[0];
+        npy_uint64 prod1 = (npy_uint64) 0xCD9E8D57u * ctr[2];
+        npy_uint32 next[4] = {
+            (npy_uint32) (prod1 >> 32) ^ ctr[1] ^ key0, (npy_uint32) prod1,
+            (npy_uint32) (prod0 >> 32) ^ ctr[3] ^ key1, (npy_uint32) prod0};
+        std::copy(next, next + 4, ctr);
+        key0 += 0x9E3779B9u;
+        key1 += 0xBB67AE85u;
+    }
+}
+
+static PyObject* jitter(PyObject* self, PyObject* args, PyObject* kwds) {
+    static const char* kwlist[] = {"penalties", "keys", "scales", "low",
+        "high", "floor", NULL};
+    PyObject* arg1 = NULL;
+    PyObject* arg_keys = NULL;
+    PyObject* arg_scales = NULL;
+    double low = 0, high = 1, floor = 0;
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "OOO|ddd", (char**) kwlist,
+                &arg1, &arg_keys, &arg_scales, &low, &high, &floor))
+        return NULL;
+    if (!PyArray_Check(arg1) || PyArray_TYPE(arg1) != NPY_FLOAT32
+            || PyArray_NDIM(arg1) != 2 || !PyArray_ISCARRAY(arg1)) {
+        PyErr_SetString(PyExc_ValueError, "Penalties must be a writeable 2-dimensional C-contiguous float32 array");
+        return NULL;
+    }
+    npy_intp J = PyArray_DIM(arg1, 0);
+    npy_intp n = PyArray_DIM(arg1, 1);
+    ArrayRef np_keys, np_scales;
+    np_keys.obj = PyArray_FROM_OTF(arg_keys, NPY_UINT64, NPY_IN_ARRAY | NPY_FORCECAST);
+    if (np_keys.obj == NULL) return NULL;
+    np_scales.obj = PyArray_FROM_OTF(arg_scales, NPY_FLOAT64, NPY_IN_ARRAY);
+    if (np_scales.obj == NULL) return NULL;
+    if (np_keys.ndim() != 1 || np_keys.dim(0) != J
+            || np_scales.ndim() != 1 || np_scales.dim(0) != J) {
+        PyErr_SetString(PyExc_ValueError, "keys and scales must have one entry per row of penalties");
+        return NULL;
+    }
+    float* penalties = (float*) PyArray_DATA((PyArrayObject*) arg1);
+    const npy_uint64* keys = np_keys.data<npy_uint64>();
+    const double* scales = np_scales.data<double>();
+    npy_intp raised = 0;
+    Py_BEGIN_ALLOW_THREADS
+    for (npy_intp i = 0; i < J; ++i) {
+        float* row = penalties + i * n;
+        npy_uint32 key0 = (npy_uint32) keys[i];
+        npy_uint32 key1 = (npy_uint32) (keys[i] >> 32);
+        // Entry t of the row uses word t % 4 of the block for counter t / 4
+        for (npy_intp start = 0; start < n; start += 4) {
+            npy_uint32 ctr[4] = {(npy_uint32) (start / 4),
+                (npy_uint32) ((npy_uint64) start >> 34), 0, 0};
+            philox4x32(ctr, key0, key1);
+            for (npy_intp t = start; t < n && t < start + 4; ++t) {
+                double r = low + (high - low)
+                    * ((ctr[t - start] + 0.5) * (1.0 / 4294967296.0));
+                double value = scales[i] * r;
+                if (value < low * floor) {
+                    value = floor * r;
+                    ++raised;
+                }
+                row[t] = (float) value;
+            }
+        }
+    }
+    Py_END_ALLOW_THREADS
+    return PyInt_FromSsize_t(raised);
+}
+
+struct SegmentsJob : public RowJob {
+    SegmentsJob(npy_intp nrows, std::vector<KernelWorkspace>* slots)
+        : RowJob(nrows, slots) {}
+
+    void run(KernelWorkspace& ws, npy_intp k) {
+        const npy_int32* row_times = times + offsets[k];
+        build_costs(ws, data.row(k), T, ranks == NULL ? NULL : ranks + k * T,
+                model, bits == NULL ? NULL : bits + k * ((T + 7) / 8));
+        fit_segments(ws.cost, row_times, offsets[k+1] - offsets[k],
+                out + 3 * (offsets[k] - k));
+    }
+
+    DataRows data;
+    const npy_uint8* bits;
+    const npy_int32* ranks;
+    CostModel model;
+    int T;
+    const npy_intp* offsets;
+    const npy_int32* times;
+    double* out;
+};
+
+static PyObject* segment_stats(PyObject* self, PyObject* args, PyObject* kwds) {
+    static const char* kwlist[] = {"data", "offsets", "times", "threads",
+        "workspace", "ranks", "cost", NULL};
+    PyObject* arg1 = NULL;
+    PyObject* arg_offsets = NULL;
+    PyObject* arg_times = NULL;
+    PyObject* arg_ws = Py_None;
+    PyObject* arg_ranks = Py_None;
+    const char* cost_name = NULL;
+    int threads = 1;
+    CostModel model;
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "OOO|iOOz", (char**) kwlist,
+                &arg1, &arg_offsets, &arg_times, &threads, &arg_ws,
+                &arg_ranks, &cost_name))
+        return NULL;
+    if (!parse_cost(cost_name, &model))
+        return NULL;
+    threads = resolve_threads(threads);
+    if (threads < 0) {
+        PyErr_SetString(PyExc_ValueError, "Number of threads must be non-negative");
+        return NULL;
+    }
+    ArrayRef np_data, np_ranks, np_offsets, np_times, np_out;
+    bool packed;
+    if (!data_array(arg1, model, np_data, &packed))
+        return NULL;
+    if (np_data.ndim() != 2) {
+        PyErr_SetString(PyExc_ValueError, "Data must be 2-dimensional");
+        return NULL;
+    }
+    if (!optional_array(arg_ranks, NPY_INT32, np_ranks, "ranks", &np_data)
+            || !optional_array(arg_offsets, NPY_INTP, np_offsets, "offsets")
+            || !optional_array(arg_times, NPY_INT32, np_times, "times"))
+        return NULL;
+    npy_intp J = np_data.dim(0);
+    npy_intp width = np_data.dim(1);
+    if (np_offsets.obj == NULL || np_times.obj == NULL
+            || np_offsets.ndim() != 1 || np_offsets.dim(0) != J + 1
+            || np_times.ndim() != 1) {
+        PyErr_SetString(PyExc_ValueError, "Changes must be given in CSR form with one row per row of data");
+        return NULL;
+    }
+    const npy_intp* offsets = np_offsets.data<npy_intp>();
+    const npy_int32* times = np_times.data<npy_int32>();
+    // For packed data, T is only known from the changes
+    int T = packed ? -1 : width;
+    for (npy_intp i = 0; i < J; ++i) {
+        npy_intp lo = offsets[i], hi = offsets[i+1];
+        bool valid = 0 <= lo && lo + 2 <= hi && hi <= np_times.dim(0)
+            && times[lo] == 0 && (T < 0 || times[hi-1] == T);
+        for (npy_intp k = lo + 1; valid && k < hi; ++k)
+            valid = times[k] > times[k-1];
+        if (!valid) {
+            PyErr_Format(PyExc_ValueError, "Changes of row %ld must increase from 0 to the length of the data", (long) i);
+            return NULL;
+        }
+        T = times[hi-1];
+    }
+    if (packed && J > 0 && (T + 7) / 8 != width) {
+        PyErr_SetString(PyExc_ValueError, "Changes do not end at the length of the data");
+        return NULL;
+    }
+    npy_intp out_dims[2] = {offsets[J] - J, 3};
+    np_out.obj = PyArray_SimpleNew(2, out_dims, NPY_FLOAT64);
+    if (np_out.obj == NULL) return NULL;
+    if (threads > J)
+        threads = std::max(J, (npy_intp) 1);
+    Workspace* ws;
+    if (!acquire_workspace(arg_ws, &ws, threads))
+        return NULL;
+    std::vector<KernelWorkspace> local;
+    std::vector<KernelWorkspace>* slots;
+    try {
+        slots = thread_slots(ws, local, threads);
+    } catch (std::bad_alloc&) {
+        release_workspace(ws);
+        return PyErr_NoMemory();
+    }
+    SegmentsJob job(J, slots);
+    job.data = data_rows(np_data);
+    job.bits = packed ? np_data.data<npy_uint8>() : NULL;
+    job.ranks = np_ranks.obj ? np_ranks.data<npy_int32>() : NULL;
+    job.model = model;
+    job.T = T;
+    job.offsets = offsets;
+    job.times = times;
+    job.out = np_out.data<double>();
+    Py_BEGIN_ALLOW_THREADS
+    run_rows(job, threads);
+    Py_END_ALLOW_THREADS
+    release_workspace(ws);
+    if (job.failed >= 0)
+        return PyErr_NoMemory();
+    return np_out.release();
 }
 
 static PyMethodDef methods[] = {
-    {"find_changes", find_changes, METH_VARARGS, "univariate dynamic programming algorithm"},
-    {"ll_difference", ll_difference, METH_VARARGS, "compute log-likelihood differences"},
+    {"find_changes", (PyCFunction) find_changes, METH_VARARGS | METH_KEYWORDS,
+        "univariate dynamic programming algorithm; with boundaries=True or an\n"
+        "int32 out array, returns an int32 array of changes including 0 and T;\n"
+        "cost is 'laplace' (default), 'normal_mean', 'normal_var' or 'bernoulli',\n"
+        "which also accepts uint8 data bit-packed by numpy.packbits; if given,\n"
+        "changes are restricted to the increasing times in candidates; segments\n"
+        "longer than max_segment_length (if nonzero) are not considered, and\n"
+        "the changes made only to cut them are then dropped, so segments\n"
+        "between the changes returned may be longer; a\n"
+        "float64 stats array of length 4 receives the mean and max numbers of\n"
+        "live candidates per time, the number of pruned candidates and the wall\n"
+        "time in seconds; with segments=True, returns (changes, segment_stats)\n"
+        "with one row per segment as for segment_stats"},
+    {"find_changes_path", (PyCFunction) find_changes_path, METH_VARARGS | METH_KEYWORDS,
+        "optimal changes of one row for the penalties scale*base_penalties at\n"
+        "every scale in [scale_min, scale_max] (CROPS); returns a list of\n"
+        "(scale, changes) in order of increasing scale, where each segmentation\n"
+        "is optimal from its scale up to the next one"},
+    {"find_changes_batch", (PyCFunction) find_changes_batch, METH_VARARGS | METH_KEYWORDS,
+        "univariate dynamic programming algorithm for many rows on native threads;\n"
+        "returns (offsets, times) with the changes of rows[k] in times[offsets[k]:offsets[k+1]],\n"
+        "including 0 and T if boundaries=True; a float64 stats array of shape\n"
+        "(len(rows), 4) receives the counters of each row as for find_changes;\n"
+        "with binseg=True, uses fast but suboptimal binary segmentation; with\n"
+        "resume=True, each row resumes its last solution saved in the workspace\n"
+        "and only re-solves around changed penalties, with identical results\n"
+        "as long as every row holds the same data in each call"},
+    {"compute_ranks", (PyCFunction) compute_ranks, METH_VARARGS | METH_KEYWORDS,
+        "int32 ranks of the values in each row of data (ties broken by position),\n"
+        "to be reused via the ranks argument of the other functions"},
+    {"ll_difference", (PyCFunction) ll_difference, METH_VARARGS | METH_KEYWORDS,
+        "compute log-likelihood differences"},
+    {"fingerprints", (PyCFunction) fingerprints, METH_VARARGS | METH_KEYWORDS,
+        "64-bit FNV-1a hash of each row of a 2-dimensional float32 penalty array,\n"
+        "as uint64; rows with equal hashes almost surely have equal penalties"},
+    {"jitter", (PyCFunction) jitter, METH_VARARGS | METH_KEYWORDS,
+        "fills each row i of a float32 penalty array in place with scales[i]*r,\n"
+        "where the r are uniform on (low, high) from a Philox4x32-10 stream keyed\n"
+        "by keys[i] and indexed by column, so every row is reproducible on its\n"
+        "own; values below low*floor become floor*r instead; returns the number\n"
+        "of values so raised"},
+    {"segment_stats", (PyCFunction) segment_stats, METH_VARARGS | METH_KEYWORDS,
+        "location, scale and log-likelihood of every segment of every row, given\n"
+        "the changes of each row (including 0 and T) in CSR form as (offsets,\n"
+        "times); returns a float64 array with one row per segment, in order:\n"
+        "the median and mean absolute deviation for 'laplace', the mean (0 for\n"
+        "'normal_var') and standard deviation for the Normal costs, and the\n"
+        "fraction of ones and its standard deviation for 'bernoulli'"},
+    {"shift_and_merge", (PyCFunction) shift_and_merge, METH_VARARGS | METH_KEYWORDS,
+        "shift/merge stage of ComputeChanges for all rows; takes and returns the\n"
+        "changes of each row (including 0 and T) as (offsets, times) in CSR form,\n"
+        "with the groups of each row as group_indptr, group_indices"},
+    {"ll_differences", (PyCFunction) ll_differences, METH_VARARGS | METH_KEYWORDS,
+        "ll_difference for many windows, window k of data[rows[k]] (or of 1D data\n"
+        "if rows is None) filling out[o_k:o_k+ends[k]-starts[k]+1] in turn; windows\n"
+        "of one row sharing segments in a row reuse the same costs"},
     {NULL, NULL, 0, NULL}
 };
 
 PyMODINIT_FUNC
 init_univariate_changes(void) {
-    (void)Py_InitModule("_univariate_changes", methods);
+    if (PyType_Ready(&WorkspaceType) < 0)
+        return;
+    PyObject* m = Py_InitModule("_univariate_changes", methods);
+    if (m == NULL)
+        return;
     import_array();
+    Py_INCREF(&WorkspaceType);
+    PyModule_AddObject(m, "Workspace", (PyObject*) &WorkspaceType);
 }
@@ -30,6 +30,7 @@
 # ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 import numpy as np
+import scipy.sparse
 import SIMPLEchangepoint
 import unittest
 import os
@@ -225,6 +226,646 @@ class TestVarianceChangeOU(unittest.TestCase):
         _approx(sorted(self.changes.items())[1][1], set(range(60, 70)))
 
 
+info2_binseg = []
+changes2_binseg = SIMPLEchangepoint.ComputeChanges(data2, lam=32,
+        seed_method='binseg', iteration_info=info2_binseg)
+
+class TestBinsegSeeding(unittest.TestCase):
+    def test_exact_changes(self):
+        _exact(changes2_binseg, changes2)
+
+    def test_iteration_info(self):
+        _exact([info['iteration'] for info in info2_binseg],
+                range(len(info2_binseg)))
+        _exact((info2_binseg[0]['solved'], info2_binseg[0]['skipped']),
+                (100, 0))
+        for info in info2_binseg[1:]:
+            _exact(info['solved'] + info['skipped'] <= 100, True)
+        _exact(info2_binseg[-1]['change_times'], len(changes2))
+        _exact(info2_binseg[-1]['changes'],
+                sum([len(inds) for inds in changes2.values()]))
+        # The last iteration stops by repeating an earlier one
+        last = info2_binseg[-1]
+        _exact(last['repeat_of'] < last['iteration'], True)
+        _exact(last['fingerprint'],
+                info2_binseg[last['repeat_of']]['fingerprint'])
+        _exact(info2_binseg[0]['times_added'], info2_binseg[0]['change_times'])
+        for prev, info in zip(info2_binseg[:-1], info2_binseg[1:]):
+            _exact(prev['change_times'] + info['times_added']
+                    - info['times_removed'], info['change_times'])
+
+
+# Binary segmentation finds no change in the short bump of time series 17
+# with the first-iteration penalties, but the dynamic program does
+np.random.seed(20140009)
+data9 = np.random.laplace(size=(20, 1000))
+data9[:6, 500:] += 2
+data9[17, 400:440] += 2.5
+changes9 = SIMPLEchangepoint.ComputeChanges(data9, lam=32)
+
+class TestBinsegUnderSegmented(unittest.TestCase):
+    def test_missed_by_binseg(self):
+        offsets, times = SIMPLEchangepoint._univariate_changes \
+                .find_changes_batch(np.array(data9[17:18], dtype='float32'),
+                np.ones((1, 999), dtype='float32') * 8, binseg=True)
+        _exact(times.tolist(), [])
+        _approx(sorted(changes9.keys()), [400, 440, 500], 3)
+
+    def test_exact_changes(self):
+        for local_resolve in (False, True):
+            _exact(SIMPLEchangepoint.ComputeChanges(data9, lam=32,
+                seed_method='binseg', local_resolve=local_resolve,
+                verbose=False), changes9)
+
+
+changes2_local = SIMPLEchangepoint.ComputeChanges(data2, lam=32,
+        local_resolve=True)
+
+class TestLocalResolve(unittest.TestCase):
+    def test_exact_changes(self):
+        _exact(changes2_local, changes2)
+
+
+groups_index = [set(range(0, 10)), set(range(5, 15)), set([3, 17]),
+        set(range(5, 15))]
+index_groups = SIMPLEchangepoint.GroupIndex(groups_index, 20)
+changes2_index = SIMPLEchangepoint.ComputeChanges(data2[:20], lam=16,
+        groups=groups_index, beta=0.5)
+
+class TestGroupIndex(unittest.TestCase):
+    def test_memberships(self):
+        _exact(index_groups.sizes.tolist(), [10, 10, 2, 10])
+        indptr = index_groups.indptr
+        for g, group in enumerate(groups_index):
+            _exact(index_groups.members[indptr[g]:indptr[g+1]].tolist(),
+                    sorted(group))
+        for j in range(20):
+            groups = [g for g, group in enumerate(groups_index) if j in group]
+            _exact(index_groups.groups_of(j), groups)
+            _exact(index_groups.signatures[index_groups.signature[j]], groups)
+        _exact(len(index_groups.signatures), 6)
+        _exact((index_groups.matrix().toarray() == [[j in group
+            for j in range(20)] for group in groups_index]).all(), True)
+        self.assertRaises(ValueError, SIMPLEchangepoint.GroupIndex,
+                [set([0, 20])], 20)
+
+    def test_penalty(self):
+        for changed in [set(), set([4]), set([3, 5, 6, 17]), set(range(20))]:
+            expect = 16.0 * (sum([len(changed & group) ** 0.5
+                for group in groups_index])) ** 0.7
+            _exact(index_groups.penalty(changed, 16.0, 0.7, 0.5), expect)
+
+    def test_reuse(self):
+        _exact(SIMPLEchangepoint.ComputeChanges(data2[:20], lam=16,
+                groups=index_groups, beta=0.5, verbose=False), changes2_index)
+
+
+class TestChangeSet(unittest.TestCase):
+    def test_algebra(self):
+        np.random.seed(6)
+        sets = [set(), set([0]), set([3, 17, 64, 99])] + \
+                [set(np.random.choice(100, n, replace=False).tolist())
+                        for n in (2, 3, 5, 40, 100)]
+        for a in sets:
+            ca = SIMPLEchangepoint.ChangeSet(sorted(a), 100)
+            _exact(ca.to_set(), a)
+            _exact(len(ca), len(a))
+            _exact(ca.contains(range(100)).tolist(),
+                    [j in a for j in range(100)])
+            _exact(cPickle.loads(cPickle.dumps(ca)), ca)
+            for b in sets:
+                cb = SIMPLEchangepoint.ChangeSet(list(b), 100)
+                _exact((ca | cb).to_set(), a | b)
+                _exact((ca & cb).to_set(), a & b)
+                _exact(ca | cb, SIMPLEchangepoint.ChangeSet(list(a | b), 100))
+                _exact(ca == cb, a == b)
+                _exact(ca != cb, a != b)
+
+    def test_diff(self):
+        J = 20
+        old = {5: [1, 2], 9: [3], 12: [4, 5], 15: [6]}
+        new = {5: [1, 2], 10: [3], 12: [4], 17: [7]}
+        old, new = [dict((t, SIMPLEchangepoint.ChangeSet(inds, J))
+            for t, inds in changes.items()) for changes in (old, new)]
+        _exact(SIMPLEchangepoint._change_diff(old, new),
+                {'times_added': 1, 'times_removed': 1, 'times_moved': 1,
+                 'times_modified': 1})
+
+    def test_penalty(self):
+        changed = SIMPLEchangepoint.ChangeSet([3, 5, 6, 17], 20)
+        _exact(index_groups.counts(changed).tolist(), [3, 2, 2, 2])
+        _exact(index_groups.penalty(changed, 16.0, 0.7, 0.5),
+                index_groups.penalty(set([3, 5, 6, 17]), 16.0, 0.7, 0.5))
+
+
+class TestMarginalPenalties(unittest.TestCase):
+    def test_dense(self):
+        np.random.seed(5)
+        totals = scipy.sparse.csr_matrix(np.random.randint(0, 3, (6, 9))
+                * (np.random.rand(6, 9) < 0.4), dtype=np.uint8)
+        dense = totals.toarray()
+        current = SIMPLEchangepoint._power_sums(totals, 0.5)
+        _exact(current.tolist(), (dense**0.5).sum(axis=0).tolist())
+        signatures = [[0, 2], [1], [3, 4, 5], [2, 3], []]
+        blocks = list(SIMPLEchangepoint._marginal_penalties(totals, current,
+                signatures, 16.0, 0.7, 0.5, chunk=18))
+        _exact(sorted(s for block, up, down in blocks for s in block),
+                range(5))
+        for block, up, down in blocks:
+            for k, s in enumerate(block):
+                submat = dense[signatures[s], :]
+                cup = current + ((submat+1)**0.5 - submat**0.5).sum(axis=0)
+                cdown = np.maximum(current + (np.maximum(submat-1,0)**0.5
+                        - submat**0.5).sum(axis=0), 0)
+                _exact(up[k].tolist(),
+                        (16.0 * (cup**0.7 - current**0.7)).tolist())
+                _exact(down[k].tolist(),
+                        (16.0 * (current**0.7 - cdown**0.7)).tolist())
+
+
+changes_nm, segments_nm = SIMPLEchangepoint.ComputeChanges(data, lam=32,
+        cost='normal_mean', return_segments=True)
+
+class TestMeanChangeNormalMeanCost(unittest.TestCase):
+    def setUp(self):
+        self.changes = changes_nm
+        self.offsets, self.segments = segments_nm
+
+    def test_exact_numchanges(self):
+        _exact(len(self.changes), 2)
+
+    def test_approx_changetimes(self):
+        _approx(sorted(self.changes.keys()), [200, 500], 10)
+
+    def test_exact_changed_traces1(self):
+        _exact(len(self.changes), 2)
+        _exact(sorted(self.changes.items())[0][1], set(range(6, 8)))
+
+    def test_exact_changed_traces2(self):
+        _exact(len(self.changes), 2)
+        _exact(sorted(self.changes.items())[1][1], set(range(5)))
+
+    def test_approx_segments(self):
+        _exact(len(self.offsets), 101)
+        _exact(np.diff(self.offsets)[[0, 6, 10]].tolist(), [2, 2, 1])
+        means = self.segments[:, 0]
+        _exact(np.abs(means[:2] - [0, 1]).max() < 0.2, True)
+        _exact(np.abs(means[self.offsets[6]:self.offsets[7]] - [1, 0]).max()
+                < 0.3, True)
+        _exact(abs(self.segments[self.offsets[10], 1] - 1) < 0.1, True)
+
+
+changes_nv = SIMPLEchangepoint.ComputeChanges(data3, lam=32, cost='normal_var')
+
+# Time series 5-11 never change (11 is constant), so they are dropped from
+# the working arrays after the first iteration
+np.random.seed(20140010)
+data10 = np.random.laplace(size=(12, 600))
+data10[:4, 300:] += 3
+data10[4, 150:] += 3
+data10[11] = 1.5
+
+class TestUnchangedTimeSeries(unittest.TestCase):
+    def _check(self, cost, local_resolve):
+        info = []
+        changes, (offsets, segments) = SIMPLEchangepoint.ComputeChanges(
+                data10, lam=32, cost=cost, return_segments=True,
+                local_resolve=local_resolve, iteration_info=info,
+                verbose=False)
+        _exact(changes, {150: set([4]), 300: set(range(4))})
+        _exact(info[0]['solved'], 12)
+        _exact(info[1]['solved'] + info[1]['skipped'], 5)
+        _exact(np.diff(offsets).tolist(), [2] * 5 + [1] * 7)
+        _exact(segments[offsets[11], :2].tolist(), [1.5, 0])
+        return offsets, segments
+
+    def test_laplace(self):
+        for local_resolve in (False, True):
+            offsets, segments = self._check('laplace', local_resolve)
+            rows = [[0, 300, 600]] * 4 + [[0, 150, 600]] + [[0, 600]] * 7
+            expect = _univariate_changes.segment_stats(
+                    np.array(data10, dtype='float32'),
+                    np.cumsum([0] + [len(row) for row in rows]),
+                    np.concatenate(rows))
+            _exact(segments.tolist(), expect.tolist())
+
+    def test_normal_mean(self):
+        for local_resolve in (False, True):
+            offsets, segments = self._check('normal_mean', local_resolve)
+            for i in range(5, 11):
+                x = np.array(data10[i], dtype='float32').astype('float64')
+                _approx(segments[offsets[i], 0], x.mean(), 1e-6)
+                _approx(segments[offsets[i], 1], x.std(), 1e-6)
+
+
+class TestMaxSegmentLength(unittest.TestCase):
+    def test_long_stationary_stretches(self):
+        # Every time series has a stationary stretch longer than the bound,
+        # and the changes it forces there are neither returned nor merged
+        expect, (offsets, segments) = SIMPLEchangepoint.ComputeChanges(
+                data10, lam=32, return_segments=True, verbose=False)
+        for max_len, local_resolve in [(100, False), (250, False),
+                (100, True)]:
+            changes, (got_offsets, got_segments) = \
+                    SIMPLEchangepoint.ComputeChanges(data10, lam=32,
+                            max_segment_length=max_len, return_segments=True,
+                            local_resolve=local_resolve, verbose=False)
+            _exact(changes, expect)
+            _exact(got_offsets.tolist(), offsets.tolist())
+            _exact(got_segments.tolist(), segments.tolist())
+
+class TestVarianceChangeNormalVarCost(unittest.TestCase):
+    def setUp(self):
+        self.changes = changes_nv
+
+    def test_exact_numchanges(self):
+        _exact(len(self.changes), 2)
+
+    def test_approx_changetimes(self):
+        _approx(sorted(self.changes.keys()), [500, 800], 10)
+
+    def test_exact_changed_traces1(self):
+        _exact(len(self.changes), 2)
+        _exact(sorted(self.changes.items())[0][1], set(range(60, 80)))
+
+    def test_exact_changed_traces2(self):
+        _exact(len(self.changes), 2)
+        _exact(sorted(self.changes.items())[1][1], set(range(80, 82)))
+
+
+np.random.seed(20140008)
+prob8 = 0.3 * np.ones((50, 999))
+prob8[:5, 500:] = 0.7
+prob8[10:12, :300] = 0.8
+data8 = np.random.uniform(size=prob8.shape) < prob8
+changes8 = SIMPLEchangepoint.ComputeChanges(data8, lam=32, cost='bernoulli')
+changes8_packed = SIMPLEchangepoint.ComputeChanges(np.packbits(data8, axis=1),
+        lam=32, cost='bernoulli', frames=999)
+
+class TestProbabilityChangeBernoulli(unittest.TestCase):
+    def setUp(self):
+        self.changes = changes8
+
+    def test_exact_numchanges(self):
+        _exact(len(self.changes), 2)
+
+    def test_approx_changetimes(self):
+        _approx(sorted(self.changes.keys()), [300, 500], 10)
+
+    def test_exact_changed_traces1(self):
+        _exact(len(self.changes), 2)
+        _exact(sorted(self.changes.items())[0][1], set(range(10, 12)))
+
+    def test_exact_changed_traces2(self):
+        _exact(len(self.changes), 2)
+        _exact(sorted(self.changes.items())[1][1], set(range(5)))
+
+    def test_exact_packed(self):
+        _exact(changes8_packed, self.changes)
+
+
+from SIMPLEchangepoint import _univariate_changes
+
+np.random.seed(20140007)
+data7 = np.array(np.random.laplace(size=(20, 500)), dtype='float32')
+data7[:10, 250:] += 2
+penalties7 = np.array(np.random.uniform(8, 16, size=(20, 499)), dtype='float32')
+
+class TestFindChangesBatch(unittest.TestCase):
+    def setUp(self):
+        self.expect = [_univariate_changes.find_changes(x, p)
+                for x, p in zip(data7, penalties7)]
+
+    def _check(self, offsets, times, rows):
+        _exact(len(offsets), len(rows) + 1)
+        for k, i in enumerate(rows):
+            _exact(times[offsets[k]:offsets[k+1]].tolist(), self.expect[i])
+
+    def test_all_rows(self):
+        offsets, times = _univariate_changes.find_changes_batch(data7,
+                penalties7)
+        self._check(offsets, times, range(20))
+
+    def test_threads(self):
+        rows = [3, 0, 17, 11, 12]
+        offsets, times = _univariate_changes.find_changes_batch(data7,
+                penalties7, threads=4, rows=rows)
+        self._check(offsets, times, rows)
+
+    def test_boundaries(self):
+        offsets, times = _univariate_changes.find_changes_batch(data7,
+                penalties7, rows=[0, 15], boundaries=True)
+        _exact(times[offsets[0]:offsets[1]].tolist(),
+                [0] + self.expect[0] + [500])
+        _exact(times[offsets[1]:offsets[2]].tolist(),
+                [0] + self.expect[15] + [500])
+
+    def test_out_array(self):
+        out = np.zeros(501, dtype='int32')
+        got = _univariate_changes.find_changes(data7[0], penalties7[0],
+                out=out)
+        _exact(got.tolist(), [0] + self.expect[0] + [500])
+        _exact(out[:len(got)].tolist(), got.tolist())
+
+    def test_workspace(self):
+        workspace = _univariate_changes.Workspace(500, threads=2)
+        for i in range(3):
+            _exact(_univariate_changes.find_changes(data7[i], penalties7[i],
+                workspace=workspace), self.expect[i])
+        offsets, times = _univariate_changes.find_changes_batch(data7,
+                penalties7, threads=2, workspace=workspace)
+        self._check(offsets, times, range(20))
+
+    def test_ranks(self):
+        ranks = _univariate_changes.compute_ranks(data7)
+        _exact(ranks.tolist(), np.argsort(np.argsort(data7, axis=1,
+            kind='mergesort'), axis=1).tolist())
+        offsets, times = _univariate_changes.find_changes_batch(data7,
+                penalties7, ranks=ranks)
+        self._check(offsets, times, range(20))
+        for prev_change, next_change, start, end in [(0, 500, 240, 260),
+                (100, 300, 100, 300), (250, 252, 250, 252)]:
+            _exact(_univariate_changes.ll_difference(data7[0], prev_change,
+                next_change, start, end, ranks=ranks[0]).tolist(),
+                _univariate_changes.ll_difference(data7[0], prev_change,
+                next_change, start, end).tolist())
+
+    def test_ll_differences(self):
+        windows = [(0, 0, 500, 240, 260), (3, 100, 300, 100, 300),
+                (3, 100, 300, 150, 160), (17, 250, 252, 250, 252)]
+        rows, prevs, nexts, starts, ends = zip(*windows)
+        expect = np.concatenate([_univariate_changes.ll_difference(data7[i],
+            prev_change, next_change, start, end)
+            for i, prev_change, next_change, start, end in windows])
+        out = np.zeros(len(expect) + 3)
+        got = _univariate_changes.ll_differences(data7, rows, prevs, nexts,
+                starts, ends, out=out, threads=2)
+        _exact(got.tolist(), expect.tolist())
+        _exact(out[:len(expect)].tolist(), expect.tolist())
+        got = _univariate_changes.ll_differences(data7[3], None, prevs[1:3],
+                nexts[1:3], starts[1:3], ends[1:3])
+        _exact(got.tolist(), expect[21:21+201+11].tolist())
+
+    def test_all_candidates(self):
+        candidates = np.arange(1, 500, dtype='int32')
+        for i in range(20):
+            _exact(_univariate_changes.find_changes(data7[i], penalties7[i],
+                candidates=candidates), self.expect[i])
+
+    def test_restricted_candidates(self):
+        candidates = np.array([50, 100, 248, 250, 252, 400], dtype='int32')
+        for i in range(10):
+            got = _univariate_changes.find_changes(data7[i], penalties7[i],
+                    candidates=candidates)
+            _approx(got, [250], 2)
+            _exact(set(got) <= set(candidates.tolist()), True)
+        self.assertRaises(ValueError, _univariate_changes.find_changes,
+                data7[0], penalties7[0], candidates=candidates[::-1])
+
+    def test_max_segment_length(self):
+        offsets, times = _univariate_changes.find_changes_batch(data7,
+                penalties7, max_segment_length=500)
+        self._check(offsets, times, range(20))
+        offsets, times = _univariate_changes.find_changes_batch(data7,
+                penalties7, boundaries=True, max_segment_length=100)
+        for i in range(20):
+            row = times[offsets[i]:offsets[i+1]]
+            _exact(row[1:-1].tolist(), _univariate_changes.find_changes(
+                data7[i], penalties7[i], max_segment_length=100))
+            # The changes forced by the bound are dropped again
+            _exact(len(row) - 2, len(self.expect[i]))
+
+    def _reference(self, x, penalties, candidates=None, max_len=None):
+        # O(T^2) dynamic program for the normal_mean cost, with segments of
+        # at least 2 points
+        x = np.array(x, dtype='float64')
+        T = len(x)
+        s1 = np.concatenate([[0], np.cumsum(x)])
+        s2 = np.concatenate([[0], np.cumsum(x * x)])
+        starts = np.array([0] + (range(1, T) if candidates is None
+            else list(candidates)))
+        best = np.zeros(T + 1) - np.inf
+        best[0] = 0
+        prev = np.zeros(T + 1, dtype='int')
+        for t in range(2, T + 1):
+            if t < T and candidates is not None and t not in candidates:
+                continue
+            s = starts[(starts <= t - 2) & (starts >= (t - max_len
+                if max_len else 0))]
+            n = t - s
+            sums = s1[t] - s1[s]
+            ll = -0.5 * (n * np.log(2 * np.pi)
+                    + np.maximum(s2[t] - s2[s] - sums * sums / n, 0))
+            scores = best[s] + ll - np.where(s > 0, penalties[s - 1], 0)
+            best[t] = scores.max()
+            prev[t] = s[np.argmax(scores)]
+        changes = []
+        t = prev[T]
+        while t > 0:
+            changes.append(int(t))
+            t = prev[t]
+        return changes[::-1]
+
+    def test_normal_mean_reference(self):
+        candidates = np.arange(1, 500, 3, dtype='int32')
+        for i in range(6):
+            x, p = data7[i], penalties7[i] / 4
+            expect = self._reference(x, p)
+            _exact(len(expect) > 2, True)
+            _exact(_univariate_changes.find_changes(x, p, cost='normal_mean'),
+                    expect)
+            _exact(_univariate_changes.find_changes(x, p, cost='normal_mean',
+                candidates=candidates), self._reference(x, p,
+                    candidates=set(candidates.tolist())))
+            # The bounded changes, less those that do not pay without the
+            # bound
+            bounded = self._reference(x, p, max_len=40)
+            _exact(_univariate_changes.find_changes(x, p, cost='normal_mean',
+                max_segment_length=40), self._reference(x, p,
+                    candidates=set(bounded)))
+        offsets, times = _univariate_changes.find_changes_batch(data7,
+                penalties7 / 4, cost='normal_mean', threads=3)
+        for i in range(6, 20):
+            _exact(times[offsets[i]:offsets[i+1]].tolist(),
+                    self._reference(data7[i], penalties7[i] / 4))
+
+    def test_path(self):
+        for i in [0, 15]:
+            path = _univariate_changes.find_changes_path(data7[i],
+                    penalties7[i], 0.5, 4.0)
+            scales = [scale for scale, changes in path]
+            _exact(scales, sorted(scales))
+            _exact(path[0][0], 0.5)
+            _exact(path[0][1], _univariate_changes.find_changes(data7[i],
+                0.5 * penalties7[i]))
+            _exact(path[-1][1], _univariate_changes.find_changes(data7[i],
+                4.0 * penalties7[i]))
+        _exact(_univariate_changes.find_changes_path(data7[0], penalties7[0],
+            1.0, 1.0)[0][1], self.expect[0])
+
+    def test_strided_data(self):
+        columns = np.array(data7.T)
+        doubles = np.array(data7, dtype='float64')
+        for rows in [columns.T, doubles, doubles.T.T[:, ::1]]:
+            offsets, times = _univariate_changes.find_changes_batch(rows,
+                    penalties7)
+            self._check(offsets, times, range(20))
+            _exact(_univariate_changes.compute_ranks(rows).tolist(),
+                    _univariate_changes.compute_ranks(data7).tolist())
+        _exact(_univariate_changes.find_changes(columns[:, 3], penalties7[3]),
+                self.expect[3])
+        _exact(_univariate_changes.ll_difference(doubles[0], 100, 300, 150,
+            160).tolist(), _univariate_changes.ll_difference(data7[0], 100,
+            300, 150, 160).tolist())
+
+    def test_segment_stats(self):
+        times = [0] + self.expect[0] + [500]
+        got, fits = _univariate_changes.find_changes(data7[0], penalties7[0],
+                segments=True)
+        _exact(got, self.expect[0])
+        _exact(fits.shape, (len(times) - 1, 3))
+        for k in range(len(times) - 1):
+            x = data7[0, times[k]:times[k+1]].astype('float64')
+            mad = np.abs(x - np.median(x)).mean()
+            _exact(abs(fits[k, 0] - np.median(x)) < 1e-6, True)
+            _exact(abs(fits[k, 1] - mad) < 1e-6, True)
+            _exact(abs(fits[k, 2] + len(x) * (1 + np.log(2 * mad))) < 1e-6, True)
+        rows = [times, [0, 100, 500], [0, 500]]
+        offsets = np.cumsum([0] + [len(row) for row in rows])
+        stats = _univariate_changes.segment_stats(data7[:3], offsets,
+                np.concatenate(rows))
+        _exact(stats[:len(times)-1].tolist(), fits.tolist())
+        _exact(len(stats), len(times) + 2)
+        fits = _univariate_changes.segment_stats(data7[:3] > 0, offsets,
+                np.concatenate(rows), cost='bernoulli')
+        _exact(fits[-1, 0], np.mean(data7[2] > 0))
+
+    def test_segment_medians(self):
+        # Order statistics of arbitrary intervals, with and without ties
+        np.random.seed(11)
+        for data in [data7[:4], np.round(data7[:4] * 2) / 2]:
+            rows, expect = [], []
+            for i in range(4):
+                for n in range(40):
+                    s = np.random.randint(1, 480)
+                    t = np.random.randint(s + 1, 500)
+                    rows.append((i, [0, s, t, 500]))
+                    expect.append(np.median(data[i, s:t].astype('float64')))
+            offsets = np.cumsum([0] + [len(row) for i, row in rows])
+            stats = _univariate_changes.segment_stats(
+                    data[[i for i, row in rows]], offsets,
+                    np.concatenate([row for i, row in rows]))
+            _exact(stats[1::3, 0].tolist(), expect)
+
+    def test_binseg(self):
+        offsets, times = _univariate_changes.find_changes_batch(data7,
+                penalties7, boundaries=True, binseg=True)
+        for i in range(10):
+            row = times[offsets[i]:offsets[i+1]].tolist()
+            _exact(row[0] == 0 and row[-1] == 500, True)
+            _exact(row, sorted(set(row)))
+            _approx([min(row, key=lambda t: abs(t - 250))], [250], 5)
+        # The splits forced by the bound are dropped again
+        bounded = _univariate_changes.find_changes_batch(data7, penalties7,
+                boundaries=True, binseg=True, max_segment_length=100)
+        _exact(bounded[0].tolist(), offsets.tolist())
+        _exact(bounded[1].tolist(), times.tolist())
+
+    def test_stats(self):
+        stats = np.zeros((20, 4))
+        _univariate_changes.find_changes_batch(data7, penalties7, stats=stats)
+        for i in range(20):
+            row_stats = np.zeros(4)
+            _exact(_univariate_changes.find_changes(data7[i], penalties7[i],
+                stats=row_stats), self.expect[i])
+            _exact(row_stats[:3].tolist(), stats[i, :3].tolist())
+            _exact(0 < row_stats[0] <= row_stats[1] < 500, True)
+            _exact(row_stats[2] > 0 and row_stats[3] >= 0, True)
+        self.assertRaises(ValueError, _univariate_changes.find_changes_batch,
+                data7, penalties7, stats=np.zeros((3, 4)))
+
+    def test_resume(self):
+        np.random.seed(4)
+        penalties = np.array(penalties7, dtype='float32')
+        workspace = _univariate_changes.Workspace(500)
+        for cost, max_len in [('laplace', 0), ('normal_mean', 0),
+                ('normal_mean', 100)]:
+            for i in range(5):
+                offsets, times = _univariate_changes.find_changes_batch(
+                        data7, penalties, workspace=workspace, cost=cost,
+                        max_segment_length=max_len, resume=True)
+                expect = _univariate_changes.find_changes_batch(data7,
+                        penalties, cost=cost, max_segment_length=max_len)
+                _exact(offsets.tolist(), expect[0].tolist())
+                _exact(times.tolist(), expect[1].tolist())
+                rows = np.random.randint(0, 20, 40)
+                cols = np.random.randint(0, 499, 40)
+                penalties[rows, cols] = np.random.uniform(0, 16, 40)
+        self.assertRaises(ValueError, _univariate_changes.find_changes_batch,
+                data7, penalties7, resume=True)
+        self.assertRaises(ValueError, _univariate_changes.find_changes_batch,
+                data7, penalties7, rows=[1, 1], workspace=workspace,
+                resume=True)
+
+    def test_fingerprints(self):
+        penalties = np.array(penalties7, dtype='float32')
+        penalties[3] = penalties[2]
+        prints = _univariate_changes.fingerprints(penalties)
+        _exact(prints.dtype, np.dtype('uint64'))
+        _exact(prints[2] == prints[3], True)
+        _exact(len(set(prints.tolist())), 19)
+        penalties[3, 100] += 1
+        _exact(_univariate_changes.fingerprints(penalties)[3] == prints[3],
+                False)
+        self.assertRaises(ValueError, _univariate_changes.fingerprints,
+                penalties[0])
+
+    def test_jitter(self):
+        penalties = np.zeros((3, 499), dtype='float32')
+        raised = _univariate_changes.jitter(penalties, [5, 7, 5],
+                [10.0, 10.0, 1.0], 0.9, 1.0, 8.0)
+        _exact(raised, 499)
+        _exact(((penalties[:2] > 9) & (penalties[:2] < 10)).all(), True)
+        _exact(np.abs(penalties[0] / 10 - penalties[2] / 8).max() < 1e-6, True)
+        _exact(penalties[0].tolist() == penalties[1].tolist(), False)
+        # Each row depends only on its key, not on the other rows
+        row = np.zeros((1, 499), dtype='float32')
+        _univariate_changes.jitter(row, [5], [10.0], 0.9, 1.0)
+        _exact(row[0].tolist(), penalties[0].tolist())
+        self.assertRaises(ValueError, _univariate_changes.jitter,
+                penalties[:, ::2], [5, 7, 5], [1.0, 1.0, 1.0])
+
+    def test_jitter_values(self):
+        # Key 0 and counter 0 give the Philox4x32-10 known-answer words of
+        # Random123, mapped to (word + 0.5) / 2**32
+        row = np.zeros((1, 4), dtype='float32')
+        _univariate_changes.jitter(row, [0], [1.0], 0.0, 1.0)
+        words = [0x6627e8d5, 0xe169c58d, 0xbc57ac4c, 0x9b00dbd8]
+        _exact(row[0].tolist(), [float(np.float32((w + 0.5) / 2.0**32))
+            for w in words])
+        # The random factors of ComputeChanges for seed 12345
+        row = np.zeros((1, 6), dtype='float32')
+        _univariate_changes.jitter(row, [12345], [10.0], 0.9, 1.0)
+        _exact(row[0].tolist(), [9.82022476196289, 9.185545921325684,
+            9.823403358459473, 9.887340545654297, 9.00278377532959,
+            9.144295692443848])
+
+    def test_shift_and_merge(self):
+        rows = [[0, 245, 500]] * 5 + [[0, 255, 500]] * 5 + [[0, 500]] * 10
+        offsets = np.cumsum([0] + [len(row) for row in rows])
+        offsets, times = _univariate_changes.shift_and_merge(data7, offsets,
+                np.concatenate(rows), np.arange(21), np.zeros(20, 'int32'),
+                16.0, 0.7, 1.0)
+        merged = times[offsets[0]+1]
+        _approx([merged], [250], 5)
+        for i in range(20):
+            _exact(times[offsets[i]:offsets[i+1]].tolist(),
+                    [0, merged, 500] if i < 10 else [0, 500])
+        self.assertRaises(ValueError, _univariate_changes.shift_and_merge,
+                data7, offsets, times[::-1], np.arange(21),
+                np.zeros(20, 'int32'), 16.0, 0.7, 1.0)
+
+
 ut_data = dict(MeanChangeIIDGaussian=(data, changes),
                MeanChangeIIDLapalce=(data2, changes2),
                VarianceChangeIIDGaussian=(data3, changes3),